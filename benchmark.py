@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from ultraprint.logging import logger as create_logger  # renamed to avoid collision
+
+# Runs scrape.py against a local stand-in for Pixabay so throughput can be
+# compared between changes without touching the live site or the API quota.
+# The mock serves listing pages, /api/ and /api/videos/ responses and media
+# payloads of configurable size and latency, and times every request itself.
+# With --api-rate-limit the API enforces a fixed-window quota and sends
+# Pixabay's X-RateLimit-* headers, answering 429 once the window is spent.
+# Per-item latency runs from the first request the scraper makes for an item
+# (its API lookup, or the media request when the item came from a search page)
+# to the end of its media transfer.
+# The default api_search harvest runs fully offline. --harvest-mode browser
+# still walks the mock's listing pages in a real Firefox, so it needs Firefox
+# and geckodriver, which is downloaded on the first such run unless
+# `geckodriver_path` is set.
+
+SCRAPE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scrape.py")
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+LINK_CLASS = "link--WHWzm"
+
+log = create_logger('benchmark_log', include_extra_info=False, write_to_file=False, log_level='INFO')
+
+# -----------------------------------------------------------------------------
+# MOCK PIXABAY SERVER
+# -----------------------------------------------------------------------------
+class MockPixabay(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, total_items, page_size, media_bytes, api_latency, media_latency,
+                 rate_limit=None, rate_window=60):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.total_items = total_items
+        self.page_size = page_size
+        self.media_bytes = media_bytes
+        self.api_latency = api_latency
+        self.media_latency = media_latency
+        self.payload = os.urandom(min(media_bytes, 1024 * 1024))
+        self.lock = threading.Lock()
+        # media_id -> first request time, last media completion, media bytes sent
+        self.items = {}
+        self.api_calls = 0
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.window_start = time.monotonic()
+        self.window_calls = 0
+        self.throttled = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def page_ids(self, page, per_page):
+        first = (page - 1) * per_page + 1
+        return list(range(first, min(first + per_page, self.total_items + 1)))
+
+    def hit(self, content_type, media_id):
+        page_url = f"{self.url}/{content_type}/item-{media_id}/"
+        if content_type == "videos":
+            return {
+                "id": media_id,
+                "pageURL": page_url,
+                "videos": {"large": {"url": f"{self.url}/media/{media_id}.mp4", "width": 1920,
+                                     "height": 1080, "size": self.media_bytes}}
+            }
+        return {
+            "id": media_id,
+            "pageURL": page_url,
+            "largeImageURL": f"{self.url}/media/{media_id}.jpg",
+            "imageSize": self.media_bytes
+        }
+
+    def rate_headers(self):
+        # Returns the X-RateLimit-* headers, or None when the call is over quota
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_calls = 0
+            reset = max(1, int(self.window_start + self.rate_window - now))
+            over = self.window_calls >= self.rate_limit
+            if over:
+                self.throttled += 1
+            else:
+                self.window_calls += 1
+            headers = {
+                "X-RateLimit-Limit": str(self.rate_limit),
+                "X-RateLimit-Remaining": str(self.rate_limit - self.window_calls),
+                "X-RateLimit-Reset": str(reset)
+            }
+        return None if over else headers, headers
+
+    def item_seen(self, media_id):
+        with self.lock:
+            self.items.setdefault(media_id, {"start": time.perf_counter(), "done": None, "bytes": 0})
+
+    def item_sent(self, media_id, sent):
+        with self.lock:
+            item = self.items[media_id]
+            item["bytes"] += sent
+            item["done"] = time.perf_counter()
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+        if len(parts) == 2 and parts[1] == "search":
+            self.listing_page(parts[0], int(query.get("pagi", 1)))
+        elif parts and parts[0] == "api":
+            self.api(parts[1] if len(parts) > 1 else "photos", query)
+        elif len(parts) == 2 and parts[0] == "media":
+            self.media(int(parts[1].split(".")[0]))
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        parts = [part for part in urlparse(self.path).path.split("/") if part]
+        if len(parts) != 2 or parts[0] != "media":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{parts[1].split(".")[0]}"')
+        self.send_header("Content-Length", str(self.server.media_bytes))
+        self.end_headers()
+
+    def listing_page(self, content_type, page):
+        ids = self.server.page_ids(page, self.server.page_size)
+        anchors = "\n".join(f'<a class="{LINK_CLASS}" href="/{content_type}/item-{media_id}/">{media_id}</a>'
+                            for media_id in ids)
+        self.send_body(f"<html><body>{anchors}</body></html>".encode("utf-8"), "text/html")
+
+    def api(self, content_type, query):
+        time.sleep(self.server.api_latency)
+        headers = {}
+        if self.server.rate_limit:
+            allowed, headers = self.server.rate_headers()
+            if allowed is None:
+                self.send_body(b"API rate limit exceeded", "text/plain", status=429, headers=headers)
+                return
+        with self.server.lock:
+            self.server.api_calls += 1
+        if "id" in query:
+            media_id = int(query["id"])
+            self.server.item_seen(media_id)
+            ids = [media_id] if media_id <= self.server.total_items else []
+        else:
+            per_page = int(query.get("per_page", 20))
+            page = int(query.get("page", 1))
+            if (page - 1) * per_page >= self.server.total_items:
+                self.send_error(400, "[ERROR 400] \"page\" is out of valid range.")
+                return
+            ids = self.server.page_ids(page, per_page)
+        body = {
+            "total": self.server.total_items,
+            "totalHits": self.server.total_items,
+            "hits": [self.server.hit(content_type, media_id) for media_id in ids]
+        }
+        self.send_body(json.dumps(body).encode("utf-8"), "application/json", headers=headers)
+
+    def media(self, media_id):
+        self.server.item_seen(media_id)
+        time.sleep(self.server.media_latency)
+        size = self.server.media_bytes
+        start, end = 0, size - 1
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            first, _, last = byte_range[len("bytes="):].partition("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{media_id}"')
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        payload = self.server.payload
+        remaining = end - start + 1
+        try:
+            while remaining:
+                chunk = payload[:min(remaining, len(payload))]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # The scraper dropped the connection, e.g. to switch to range requests
+            self.close_connection = True
+            return
+        self.server.item_sent(media_id, end - start + 1)
+
+# -----------------------------------------------------------------------------
+# BENCHMARK RUN
+# -----------------------------------------------------------------------------
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run_benchmark(args):
+    server = MockPixabay(args.items, args.page_size, args.media_kb * 1024,
+                         args.api_latency_ms / 1000, args.media_latency_ms / 1000,
+                         args.api_rate_limit, args.rate_window)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Mock Pixabay listening on {server.url}")
+
+    work_dir = tempfile.mkdtemp(prefix="pixabay-bench-")
+    with open(CONFIG_FILE, "r") as f:
+        bench_config = json.load(f)
+    bench_config.update({
+        "site_url": server.url,
+        "target_downloads": args.items,
+        "harvest_mode": args.harvest_mode,
+        "headless": True,
+        "download_delay": 0.5,
+        "latency_sample_items": 0
+    })
+    for override in args.set:
+        key, _, value = override.partition("=")
+        bench_config[key] = json.loads(value)
+    with open(os.path.join(work_dir, "config.json"), "w") as f:
+        json.dump(bench_config, f, indent=4)
+
+    log.info(f"Running scrape.py for {args.items} {args.content_type} in {work_dir}")
+    env = dict(os.environ, API_KEY="benchmark")
+    started = time.perf_counter()
+    with open(os.path.join(work_dir, "scrape.log"), "w") as scrape_log:
+        result = subprocess.run([sys.executable, SCRAPE_SCRIPT, args.content_type], cwd=work_dir,
+                                env=env, text=True, stdout=scrape_log, stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    complete = [item for item in server.items.values() if item["bytes"] >= server.media_bytes]
+    latencies = [item["done"] - item["start"] for item in complete]
+    sent = sum(item["bytes"] for item in server.items.values())
+    report = {
+        "exit_code": result.returncode,
+        "items": len(complete),
+        "seconds": round(elapsed, 3),
+        "items_per_sec": round(len(complete) / elapsed, 3),
+        "p50_item_latency": round(percentile(latencies, 0.5), 4) if latencies else None,
+        "p95_item_latency": round(percentile(latencies, 0.95), 4) if latencies else None,
+        "bytes_per_sec": round(sent / elapsed),
+        "api_calls": server.api_calls,
+        "api_throttled": server.throttled,
+        "work_dir": work_dir
+    }
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        report["work_dir"] = None
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scrape.py against a local mock Pixabay server.")
+    parser.add_argument("--content-type", choices=["photos", "videos"], default="photos")
+    parser.add_argument("--harvest-mode", choices=["browser", "api_search"], default="api_search")
+    parser.add_argument("--items", type=int, default=200, help="Items the mock serves and the scraper targets")
+    parser.add_argument("--page-size", type=int, default=100, help="Items per mock listing page")
+    parser.add_argument("--media-kb", type=int, default=512, help="Size of every media payload in KB")
+    parser.add_argument("--api-latency-ms", type=float, default=50)
+    parser.add_argument("--media-latency-ms", type=float, default=100)
+    parser.add_argument("--api-rate-limit", type=int, help="API calls allowed per rate window")
+    parser.add_argument("--rate-window", type=float, default=60, help="Length of the API rate window in seconds")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=JSON",
+                        help="Override a config.json value for the run, e.g. --set download_workers=8")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory and scrape.log")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    if report["exit_code"]:
+        log.error(f"scrape.py exited with code {report['exit_code']}")
+    log.info(f"Items downloaded:  {report['items']} in {report['seconds']}s")
+    log.info(f"Throughput:        {report['items_per_sec']} items/s, "
+             f"{report['bytes_per_sec'] / 1024 / 1024:.2f} MB/s")
+    log.info(f"Per-item latency:  p50 {report['p50_item_latency']}s, p95 {report['p95_item_latency']}s")
+    log.info(f"API calls:         {report['api_calls']} ({report['api_throttled']} throttled)")
+    if report["work_dir"]:
+        log.info(f"Work directory:    {report['work_dir']}")
+
+if __name__ == "__main__":
+    main()
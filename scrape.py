@@ -1,8 +1,32 @@
 import os
+import argparse
 import time
 import json
+import math
+import gzip
+import io
+import shutil
+import tempfile
+import queue
+import socket
+import sqlite3
+import hashlib
+import statistics
+import threading
+import multiprocessing
+import random
+import signal
+import tarfile
 import requests
+import urllib3
 from datetime import datetime
+from contextlib import contextmanager, nullcontext
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import islice
+from urllib.parse import urlencode, unquote
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -10,12 +34,28 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.firefox.options import Options
 from webdriver_manager.firefox import GeckoDriverManager
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from ultraprint.logging import logger as create_logger  # renamed to avoid collision
 from tqdm import tqdm  # For loading bar during chunk download
 from dotenv import load_dotenv
 from ultraconfiguration import UltraConfig
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = pq = None
+
+try:
+    from seleniumwire import webdriver as wire_webdriver
+except ImportError:  # Only needed for music
+    wire_webdriver = None
+
+try:
+    from PIL import Image
+except ImportError:  # Decode checks and thumbnails are optional
+    Image = None
+
 # load the configuration
 config = UltraConfig("config.json")
 
@@ -27,64 +67,554 @@ TARGET_DOWNLOADS = config.get("target_downloads")
 firefox_binary = config.get("firefox_binary")
 download_format = config.get("download_format")
 download_delay = config.get("download_delay")
+site_url = config.get("site_url", "https://pixabay.com")
+crawl_mode = config.get("crawl_mode", "resume")
 
 # -----------------------------------------------------------------------------
 # CONTENT TYPE SELECTION & CONFIGURATION
 # -----------------------------------------------------------------------------
-content_type = input("Choose content type (photos/videos): ").strip().lower()
-if content_type == "photos":
-    DOWNLOAD_FOLDER = os.path.join("data", "images", "photo_files")
-    PROGRESS_FILE = os.path.join("data", "images", "progress.json")
-    metadata_file = os.path.join("data", "images", "metadata.json")
-    BASE_URL = "https://pixabay.com/photos/search/?order=ec&pagi={}"
-else:
-    DOWNLOAD_FOLDER = os.path.join("data", "videos", "video_files")
-    PROGRESS_FILE = os.path.join("data", "videos", "progress.json")
-    metadata_file = os.path.join("data", "videos", "metadata.json")
-    BASE_URL = "https://pixabay.com/videos/search/?order=ec&pagi={}"
+# The content type is given on the command line. Everything for one content
+# type lives under data/images, data/videos or data/audios: the download folder,
+# progress.db (next to the legacy progress.json), metadata.json, stats.json, the
+# shards, thumbnails and the API response cache. Pixabay has no music API, so
+# music is always resolved in the browser.
+def select_content_type(kind):
+    global content_type, DOWNLOAD_FOLDER, PROGRESS_FILE, metadata_file, BASE_URL, API_URL, LINK_SELECTOR
+    global STATS_FILE, STATE_DB, SHARD_FOLDER, SHARD_INDEX_FILE, THUMBNAIL_FOLDER, API_CACHE_FOLDER
+    content_type = kind
+    if content_type == "photos":
+        DOWNLOAD_FOLDER = os.path.join("data", "images", "photo_files")
+        PROGRESS_FILE = os.path.join("data", "images", "progress.json")
+        metadata_file = os.path.join("data", "images", "metadata.json")
+        BASE_URL = site_url + f"/photos/search/?order=ec&pagi={{}}"
+        API_URL = site_url + "/api/"
+    elif content_type == "music":
+        DOWNLOAD_FOLDER = os.path.join("data", "audios", "audio_files")
+        PROGRESS_FILE = os.path.join("data", "audios", "progress.json")
+        metadata_file = os.path.join("data", "audios", "metadata.json")
+        BASE_URL = site_url + f"/music/search/?order=ec&pagi={{}}"
+        API_URL = None
+        LINK_SELECTOR = "a.name--q8l1g"
+    else:
+        DOWNLOAD_FOLDER = os.path.join("data", "videos", "video_files")
+        PROGRESS_FILE = os.path.join("data", "videos", "progress.json")
+        metadata_file = os.path.join("data", "videos", "metadata.json")
+        BASE_URL = site_url + f"/videos/search/?order=ec&pagi={{}}"
+        API_URL = site_url + "/api/videos/"
+    data_folder = os.path.dirname(PROGRESS_FILE)
+    STATS_FILE = os.path.join(data_folder, "stats.json")
+    STATE_DB = os.path.join(data_folder, "progress.db")
+    SHARD_FOLDER = os.path.join(data_folder, "shards")
+    SHARD_INDEX_FILE = os.path.join(SHARD_FOLDER, "index.jsonl")
+    THUMBNAIL_FOLDER = os.path.join(data_folder, "thumbnails")
+    API_CACHE_FOLDER = os.path.join(data_folder, "api_cache")
 
 # -----------------------------------------------------------------------------
 # CONFIGURATION & SETUP
 # -----------------------------------------------------------------------------
-# All data is stored under data folder; video files are in data/videos/video_files
-for folder in [DOWNLOAD_FOLDER, os.path.dirname(PROGRESS_FILE)]:
-    os.makedirs(folder, exist_ok=True)
 log = create_logger('scraping_log', include_extra_info=False, write_to_file=False, log_level='DEBUG')
-log.debug("Required directories are created or already exist")
+
+# -----------------------------------------------------------------------------
+# METRICS
+# -----------------------------------------------------------------------------
+# Wall time is accumulated per pipeline stage, next to counters for bytes,
+# retries and failures by reason. A snapshot is written to stats.json every
+# `stats_interval` seconds and, when `metrics_port` is set, served in the
+# Prometheus text format at http://<host>:<metrics_port>/metrics.
+stats_interval = config.get("stats_interval", 30)
+metrics_port = config.get("metrics_port")
+metrics_lock = threading.Lock()
+metrics_started = time.time()
+stage_times = {}
+counters = {"items_downloaded": 0, "bytes_downloaded": 0, "pages_harvested": 0, "retries": 0,
+            "throttled": 0, "skipped_existing": 0, "hardlinked": 0}
+failures = {}
+stats_stop = threading.Event()
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stage, time.perf_counter() - start)
+
+def add_stage_time(stage, elapsed):
+    with metrics_lock:
+        entry = stage_times.setdefault(stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] += elapsed
+        entry["max_seconds"] = max(entry["max_seconds"], elapsed)
+
+def count(name, amount=1):
+    with metrics_lock:
+        counters[name] += amount
+
+def count_failure(reason):
+    with metrics_lock:
+        failures[reason] = failures.get(reason, 0) + 1
+
+def stats_snapshot():
+    with metrics_lock:
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "uptime_seconds": round(time.time() - metrics_started, 1),
+            "stages": {stage: dict(entry, avg_seconds=entry["seconds"] / entry["count"])
+                       for stage, entry in stage_times.items()},
+            "counters": dict(counters),
+            "failures": dict(failures)
+        }
+
+def write_stats():
+    snapshot = stats_snapshot()
+    with open(STATS_FILE + ".tmp", "w") as f:
+        json.dump(snapshot, f, indent=2)
+    os.replace(STATS_FILE + ".tmp", STATS_FILE)
+    return snapshot
+
+def stats_writer():
+    while not stats_stop.wait(stats_interval):
+        snapshot = write_stats()
+        log.debug(f"Stats: {json.dumps(snapshot['counters'])}")
+
+def prometheus_text():
+    snapshot = stats_snapshot()
+    lines = [
+        "# TYPE pixabay_stage_seconds_total counter",
+        *[f'pixabay_stage_seconds_total{{stage="{stage}"}} {entry["seconds"]:.6f}'
+          for stage, entry in snapshot["stages"].items()],
+        "# TYPE pixabay_stage_calls_total counter",
+        *[f'pixabay_stage_calls_total{{stage="{stage}"}} {entry["count"]}'
+          for stage, entry in snapshot["stages"].items()],
+        "# TYPE pixabay_failures_total counter",
+        *[f'pixabay_failures_total{{reason="{reason}"}} {value}'
+          for reason, value in snapshot["failures"].items()]
+    ]
+    for name, value in snapshot["counters"].items():
+        lines.append(f"# TYPE pixabay_{name}_total counter")
+        lines.append(f"pixabay_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics():
+    threading.Thread(target=stats_writer, name="stats-writer", daemon=True).start()
+    if metrics_port:
+        server = ThreadingHTTPServer(("", metrics_port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        log.info(f"Prometheus metrics served on port {metrics_port}")
+
+def stop_metrics():
+    stats_stop.set()
+    snapshot = write_stats()
+    for stage, entry in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        log.info(f"Stage {stage}: {entry['seconds']:.1f}s total over {entry['count']} calls "
+                 f"({entry['avg_seconds']:.3f}s avg, {entry['max_seconds']:.3f}s max)")
+    if snapshot["failures"]:
+        log.info(f"Failures by reason: {json.dumps(snapshot['failures'])}")
 
 # -----------------------------------------------------------------------------
 # PROGRESS HANDLING
 # -----------------------------------------------------------------------------
+# Progress is kept in a SQLite database next to the old progress.json. Processed
+# URLs are appended as indexed rows and the page/total counters live in a small
+# key/value table, so recording an item never rewrites the whole state and an
+# interrupted write cannot corrupt it. The write-ahead log is compacted every
+# `progress_compact_every` updates.
+progress_compact_every = config.get("progress_compact_every", 500)
+
+state_db = None
+
+def open_state_db():
+    global state_db
+    state_db = sqlite3.connect(STATE_DB, timeout=30, check_same_thread=False)
+    state_db.execute("PRAGMA journal_mode=WAL")
+    state_db.execute("PRAGMA synchronous=NORMAL")
+    state_db.executescript("""
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS processed (
+            url TEXT PRIMARY KEY,
+            media_id TEXT,
+            page INTEGER,
+            timestamp TEXT
+        );
+        CREATE INDEX IF NOT EXISTS processed_media_id ON processed (media_id);
+        CREATE TABLE IF NOT EXISTS metadata_index (
+            media_id TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS page_leases (
+            page INTEGER PRIMARY KEY,
+            owner TEXT,
+            expires REAL NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS content (
+            media_id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT,
+            etag TEXT
+        );
+        CREATE INDEX IF NOT EXISTS content_sha256 ON content (sha256);
+        CREATE TABLE IF NOT EXISTS shard_index (
+            media_id TEXT PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            member TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            meta_offset INTEGER NOT NULL,
+            meta_size INTEGER NOT NULL,
+            end INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS shard_index_shard ON shard_index (shard);
+    """)
+
+progress_updates = 0
+
+def media_id_from_url(url):
+    return url.rstrip("/").split("-")[-1]
+
+def migrate_progress_file():
+    # One-time import of a legacy progress.json into the state database
+    if not os.path.exists(PROGRESS_FILE):
+        return
+    if state_db.execute("SELECT COUNT(*) FROM state").fetchone()[0]:
+        log.debug("State database already initialised, leaving progress.json untouched")
+        return
+    with open(PROGRESS_FILE, "r") as f:
+        legacy = json.load(f)
+    with state_db:
+        state_db.executemany(
+            "INSERT OR IGNORE INTO processed (url, media_id, page, timestamp) VALUES (?, ?, NULL, NULL)",
+            [(url, media_id_from_url(url)) for url in legacy.get("processed_urls", [])]
+        )
+        state_db.executemany(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+            [("current_page", legacy.get("current_page", 1)),
+             ("total_downloaded", legacy.get("total_downloaded", 0))]
+        )
+    os.replace(PROGRESS_FILE, PROGRESS_FILE + ".migrated")
+    log.info(f"Migrated {len(legacy.get('processed_urls', []))} processed URLs from progress.json")
+
 def load_progress():
-    if os.path.exists(PROGRESS_FILE):
-        with open(PROGRESS_FILE, "r") as f:
-            log.debug("Progress file loaded")
-            return json.load(f)
+    migrate_progress_file()
+    counters = dict(state_db.execute("SELECT key, value FROM state").fetchall())
+    if not counters:
+        log.debug("No progress found. Starting fresh.")
     else:
-        log.debug("No progress file found. Starting fresh.")
-        return {"current_page": 1, "processed_urls": [], "total_downloaded": 0}
+        log.debug("Progress loaded from state database")
+    return {
+        "current_page": counters.get("current_page", 1),
+        "processed_urls": {row[0] for row in state_db.execute("SELECT url FROM processed")},
+        "total_downloaded": counters.get("total_downloaded", 0)
+    }
 
-def update_progress(progress_data):
-    with open(PROGRESS_FILE, "w") as f:
-        json.dump(progress_data, f, indent=2)
+def record_processed(progress_data, url, media_id, page):
+    # Staged in the open transaction; committed together with the counters.
+    # Returns False when another process already recorded the URL.
+    progress_data["processed_urls"].add(url)
+    seen_ids.add(media_id)
+    cursor = state_db.execute(
+        "INSERT OR IGNORE INTO processed (url, media_id, page, timestamp) VALUES (?, ?, ?, ?)",
+        (url, media_id, page, datetime.now().isoformat())
+    )
+    return cursor.rowcount == 1
+
+def update_progress(progress_data, finished_page=None):
+    # Callers hold state_lock. BEGIN IMMEDIATE takes the database write lock up
+    # front, which also serialises metadata appends between processes sharing
+    # the data folder. Buffered metadata, the processed URLs behind it and the
+    # finished page are committed together, and the counters are re-read so
+    # they include work recorded by other processes.
+    global progress_updates
+    with timed("progress_commit"), state_db:
+        state_db.execute("BEGIN IMMEDIATE")
+        recorded = flush_metadata()
+        if finished_page is not None:
+            state_db.execute("UPDATE page_leases SET done = 1 WHERE page = ?", (finished_page,))
+        state_db.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('total_downloaded', 0)")
+        state_db.execute("UPDATE state SET value = value + ? WHERE key = 'total_downloaded'", (recorded,))
+        state_db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('current_page', ?)",
+                         (resume_page(),))
+        counters = dict(state_db.execute("SELECT key, value FROM state").fetchall())
+    progress_data["current_page"] = counters["current_page"]
+    progress_data["total_downloaded"] = counters["total_downloaded"]
+    progress_updates += 1
+    if progress_compact_every and progress_updates % progress_compact_every == 0:
+        state_db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        log.debug("State database compacted")
     log.debug("Progress updated")
 
-progress = load_progress()
+# Loaded by setup()
+progress = None
+
+# -----------------------------------------------------------------------------
+# PAGE LEASES
+# -----------------------------------------------------------------------------
+# Several scraper processes can share one data folder. Each listing page is
+# claimed as a lease that expires after `lease_seconds` unless its owner keeps
+# renewing it; pages whose owner died become claimable again once the lease
+# runs out. SQLite's file locking is reliable on local disks but not on every
+# network filesystem, so boxes sharing a volume need one that supports it.
+LEASE_OWNER = f"{socket.gethostname()}-{os.getpid()}"
+lease_seconds = config.get("lease_seconds", 600)
+lease_floor = 1
+lease_heartbeat_stop = threading.Event()
+
+def resume_page():
+    unfinished, highest = state_db.execute(
+        "SELECT MIN(CASE WHEN done = 0 THEN page END), MAX(page) FROM page_leases"
+    ).fetchone()
+    if unfinished is not None:
+        return unfinished
+    return max(lease_floor, (highest or 0) + 1)
+
+def lease_page(last_page=None):
+    # Reclaims the lowest expired page, otherwise leases the next new one
+    now = time.time()
+    with state_db:
+        state_db.execute("BEGIN IMMEDIATE")
+        row = state_db.execute(
+            "SELECT page FROM page_leases WHERE done = 0 AND expires < ? ORDER BY page LIMIT 1", (now,)
+        ).fetchone()
+        if row:
+            page = row[0]
+            log.info(f"Reclaiming expired lease on page {page}")
+        else:
+            highest = state_db.execute("SELECT MAX(page) FROM page_leases").fetchone()[0]
+            page = max(lease_floor, (highest or 0) + 1)
+        if last_page is not None and page > last_page:
+            return None
+        state_db.execute(
+            "INSERT OR REPLACE INTO page_leases (page, owner, expires, done) VALUES (?, ?, ?, 0)",
+            (page, LEASE_OWNER, now + lease_seconds)
+        )
+    return page
+
+def drop_lease(page):
+    # For pages past the end of the listing, so a later run can try them again
+    with state_db:
+        state_db.execute("DELETE FROM page_leases WHERE page = ? AND owner = ? AND done = 0",
+                         (page, LEASE_OWNER))
+
+def release_leases():
+    # Unfinished pages become claimable immediately after a clean shutdown
+    with state_db:
+        state_db.execute("UPDATE page_leases SET expires = 0 WHERE owner = ? AND done = 0", (LEASE_OWNER,))
+
+def lease_heartbeat():
+    while not lease_heartbeat_stop.wait(lease_seconds / 3):
+        with state_lock, state_db:
+            state_db.execute("UPDATE page_leases SET expires = ? WHERE owner = ? AND done = 0",
+                             (time.time() + lease_seconds, LEASE_OWNER))
+        log.debug("Renewed page leases")
+
+# -----------------------------------------------------------------------------
+# INCREMENTAL RE-CRAWL
+# -----------------------------------------------------------------------------
+# With `crawl_mode` "incremental" the same Editor's Choice listing is walked from
+# page 1, where new picks show up, instead of resuming at `current_page`, and
+# the crawl stops once `incremental_stop_pages` consecutive pages hold nothing
+# but known items. Page leases are left alone so the main crawl's resume point
+# is untouched, and `target_downloads` counts the items fetched by this run.
+# Known media IDs are kept in a Bloom filter built from the processed table; a
+# hit is confirmed against the table, so a false positive never skips a new item.
+incremental_stop_pages = config.get("incremental_stop_pages", 3)
+known_pages = set()
+next_incremental_page = 1
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+def load_seen_ids():
+    media_ids = [row[0] for row in state_db.execute("SELECT media_id FROM processed")]
+    seen = BloomFilter(max(100000, 2 * len(media_ids), 2 * TARGET_DOWNLOADS))
+    for media_id in media_ids:
+        seen.add(media_id)
+    log.debug(f"Loaded {len(media_ids)} known media IDs into the seen filter "
+              f"({len(seen.bits) / 1024:.0f} KB, {seen.hashes} hashes)")
+    return seen
+
+seen_ids = None
+
+def known_media_id(media_id):
+    if media_id not in seen_ids:
+        return False
+    with state_lock:
+        return state_db.execute("SELECT 1 FROM processed WHERE media_id = ? LIMIT 1",
+                                (media_id,)).fetchone() is not None
+
+def claim_incremental_page():
+    global next_incremental_page
+    page = next_incremental_page
+    if last_page is not None and page > last_page:
+        return None
+    next_incremental_page += 1
+    return page
+
+def note_known_page(page):
+    # Stops the walk at the end of any run of all-known pages this page completes
+    with state_lock:
+        known_pages.add(page)
+        for end in range(page, page + incremental_stop_pages):
+            start = end - incremental_stop_pages + 1
+            if start >= 1 and all(p in known_pages for p in range(start, end + 1)):
+                log.info(f"Pages {start}-{end} hold only known items, stopping the incremental crawl")
+                mark_last_page(end)
+                return
 
 # -----------------------------------------------------------------------------
 # FIREFOX DRIVER SETUP
 # -----------------------------------------------------------------------------
-options = Options()
-options.binary_location = firefox_binary
-if not os.path.exists(firefox_binary):
-    log.error(f"Firefox binary not found at: {firefox_binary}")
-    exit(1)
-options.set_preference("browser.download.dir", DOWNLOAD_FOLDER)
-options.set_preference("browser.download.folderList", 2)
-options.set_preference("browser.helperApps.neverAsk.saveToDisk", download_format)
-service = Service(GeckoDriverManager().install())
-driver = webdriver.Firefox(service=service, options=options)
-log.debug("Firefox WebDriver initialized")
+# Every browser worker gets its own Firefox (and geckodriver) instance, started
+# the first time a worker needs a browser. Firefox runs headless unless
+# `headless` is off or --headed is given. Workers run on the persistent profile
+# in `firefox_profile`, so a Pixabay login made once with --login is reused by
+# every later run. Firefox locks a profile while it runs, so only the first
+# worker uses it directly and the others get a throwaway copy.
+#
+# webdriver-manager asks GitHub for the newest geckodriver on every call, so the
+# resolved path is cached in data/geckodriver.json and reused while the file
+# exists. `geckodriver_path` in config.json skips the lookup altogether.
+browser_workers = config.get("browser_workers", 1)
+browser_restarts = config.get("browser_restarts", 2)
+headless = config.get("headless", True)
+firefox_profile = config.get("firefox_profile", "data/firefox_profile")
+GECKODRIVER_CACHE = os.path.join("data", "geckodriver.json")
+geckodriver_path = config.get("geckodriver_path")
+driver_lock = threading.Lock()
+profile_in_use = False
+
+def check_firefox():
+    if not os.path.exists(firefox_binary):
+        log.error(f"Firefox binary not found at: {firefox_binary}")
+        exit(1)
+
+def resolve_geckodriver():
+    global geckodriver_path
+    with driver_lock:
+        if geckodriver_path and os.path.exists(geckodriver_path):
+            return geckodriver_path
+        try:
+            with open(GECKODRIVER_CACHE, "r") as f:
+                geckodriver_path = json.load(f)["path"]
+        except (OSError, ValueError, KeyError):
+            geckodriver_path = None
+        if not geckodriver_path or not os.path.exists(geckodriver_path):
+            log.info("Resolving geckodriver")
+            geckodriver_path = GeckoDriverManager().install()
+            os.makedirs(os.path.dirname(GECKODRIVER_CACHE), exist_ok=True)
+            with open(GECKODRIVER_CACHE, "w") as f:
+                json.dump({"path": geckodriver_path, "resolved": datetime.now().isoformat()}, f)
+        return geckodriver_path
+
+def claim_profile():
+    global profile_in_use
+    with driver_lock:
+        if not profile_in_use:
+            profile_in_use = True
+            os.makedirs(firefox_profile, exist_ok=True)
+            return firefox_profile
+    copy = tempfile.mkdtemp(prefix="pixabay-profile-")
+    shutil.copytree(firefox_profile, copy, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns("lock", ".parentlock", "parent.lock"))
+    return copy
+
+def release_profile(profile):
+    global profile_in_use
+    if profile == firefox_profile:
+        with driver_lock:
+            profile_in_use = False
+    elif profile:
+        shutil.rmtree(profile, ignore_errors=True)
+
+def launch_driver(show=False):
+    options = Options()
+    options.binary_location = firefox_binary
+    if headless and not show:
+        options.add_argument("-headless")
+    profile = claim_profile() if firefox_profile else None
+    if profile:
+        options.add_argument("-profile")
+        options.add_argument(os.path.abspath(profile))
+    options.set_preference("browser.download.dir", os.path.abspath(DOWNLOAD_FOLDER))
+    options.set_preference("browser.download.folderList", 2)
+    options.set_preference("browser.helperApps.neverAsk.saveToDisk", download_format)
+    firefox = wire_webdriver if content_type == "music" else webdriver
+    try:
+        driver = firefox.Firefox(service=Service(resolve_geckodriver()), options=options)
+    except Exception:
+        release_profile(profile)
+        raise
+    driver.profile_path = profile
+    if content_type == "music":
+        # Only audio downloads from the CDN are captured, and never completed
+        driver.scopes = [AUDIO_CDN_PATTERN]
+        driver.request_interceptor = stop_audio_download
+    log.debug("Firefox WebDriver initialized")
+    return driver
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception as e:
+        log.debug(f"Ignoring error while closing Firefox: {str(e)}")
+    release_profile(driver.profile_path)
+
+def driver_alive(driver):
+    # A per-item timeout leaves the browser usable; a crash fails every command
+    try:
+        driver.window_handles
+        return True
+    except WebDriverException:
+        return False
+
+def login():
+    # Opens a visible Firefox on the saved profile so the user can sign in once
+    if not firefox_profile:
+        log.error("Set firefox_profile in config.json to keep a login between runs")
+        exit(1)
+    driver = launch_driver(show=True)
+    try:
+        driver.get(site_url + "/accounts/login/")
+        input("Log in to Pixabay in the Firefox window, then press Enter here. [Enter]")
+    finally:
+        quit_driver(driver)
+    log.info(f"Login saved in the Firefox profile at {firefox_profile}")
 
 # -----------------------------------------------------------------------------
 # UTILITY FUNCTIONS
@@ -99,39 +629,1242 @@ def wait_for_element(driver, by, value, timeout=20):
         log.error(f"Timeout waiting for element: {by} {value}")
         raise
 
+# -----------------------------------------------------------------------------
+# RATE GOVERNOR
+# -----------------------------------------------------------------------------
+# One governor paces the API and another the CDN downloads. Each keeps a token
+# bucket refilled at `*_rate_limit` requests per minute and clamped to the
+# X-RateLimit-Remaining header, blocks new requests until X-RateLimit-Reset (or
+# Retry-After) once the quota is spent, and adjusts how many requests may run at
+# once AIMD-style: +1/n per healthy response, halved on a 429 or failure and cut
+# by a quarter when a response takes over `governor_slow_factor` times the
+# average latency. Requests wait for the governor instead of failing.
+governor_slow_factor = config.get("governor_slow_factor", 3)
+
+class RateGovernor:
+    def __init__(self, name, per_minute, max_concurrency):
+        self.name = name
+        self.rate = per_minute / 60 if per_minute else None
+        self.capacity = float(per_minute or 0)
+        self.tokens = self.capacity
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.active = 0
+        self.latency = None
+        self.cond = threading.Condition()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def take_token(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.rate and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    if self.rate:
+                        self.tokens -= 1
+                    return
+                self.cond.wait(wait)
+
+    @contextmanager
+    def slot(self):
+        with self.cond:
+            while self.active >= int(self.concurrency):
+                self.cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    def observe(self, resp, latency):
+        headers = resp.headers
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        with self.cond:
+            now = time.monotonic()
+            if remaining is not None:
+                self.refill(now)
+                self.tokens = min(self.tokens, float(remaining))
+                if int(remaining) <= 0 and reset is not None:
+                    self.blocked_until = max(self.blocked_until, now + float(reset))
+            if resp.status_code == 429:
+                wait = float(headers.get("Retry-After") or reset or 60)
+                self.blocked_until = max(self.blocked_until, now + wait)
+                self.concurrency = max(1.0, self.concurrency / 2)
+                log.warning(f"{self.name} rate limited, holding requests for {wait:.0f}s "
+                            f"at concurrency {int(self.concurrency)}")
+            elif resp.status_code >= 500:
+                self.concurrency = max(1.0, self.concurrency / 2)
+            elif self.latency is not None and latency > governor_slow_factor * self.latency:
+                self.concurrency = max(1.0, self.concurrency * 0.75)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.cond.notify_all()
+
+    def failed(self):
+        with self.cond:
+            self.concurrency = max(1.0, self.concurrency / 2)
+
+api_governor = RateGovernor("API", config.get("api_rate_limit", 100), config.get("api_max_concurrency", 4))
+cdn_governor = RateGovernor("CDN", config.get("cdn_rate_limit"), config.get("cdn_max_concurrency", 16))
+
+# -----------------------------------------------------------------------------
+# HTTP CLIENT
+# -----------------------------------------------------------------------------
+# One pooled session serves every API call and media download so connections to
+# pixabay.com and the CDN are kept alive between items. Connection errors and
+# 5xx responses are retried with exponential backoff and full jitter; 429s are
+# retried once the governor lets the request through again.
+api_timeout = config.get("max_api_timeout", 20)
+download_timeout = config.get("download_timeout", 60)
+http_retries = config.get("http_retries", 3)
+http_backoff = config.get("http_backoff", 1)
+RETRY_STATUSES = {500, 502, 503, 504}
+
+http = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=config.get("http_pool_hosts", 4),
+                           pool_maxsize=config.get("http_pool_size", 16))
+http.mount("https://", http_adapter)
+http.mount("http://", http_adapter)
+
+def http_get(url, **kwargs):
+    return http_request("GET", url, **kwargs)
+
+def http_head(url, **kwargs):
+    return http_request("HEAD", url, allow_redirects=True, **kwargs)
+
+def http_request(method, url, timeout=api_timeout, governor=None, **kwargs):
+    governor = governor or api_governor
+    attempt = 0
+    while True:
+        governor.take_token()
+        try:
+            # Streamed downloads hold their slot for the whole transfer instead
+            with nullcontext() if kwargs.get("stream") else governor.slot():
+                start = time.perf_counter()
+                resp = http.request(method, url, timeout=timeout, **kwargs)
+            governor.observe(resp, time.perf_counter() - start)
+            if resp.status_code == 429:
+                count("throttled")
+                resp.close()
+                continue
+            if resp.status_code not in RETRY_STATUSES or attempt == http_retries:
+                return resp
+            log.warning(f"HTTP {resp.status_code} from {url}, retrying")
+            resp.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            governor.failed()
+            if attempt == http_retries:
+                raise
+            log.warning(f"Request to {url} failed ({str(e)}), retrying")
+        count("retries")
+        time.sleep(random.uniform(0, http_backoff * 2 ** attempt))
+        attempt += 1
+
+# -----------------------------------------------------------------------------
+# TRANSFER PROGRESS
+# -----------------------------------------------------------------------------
+# One line reports all downloads at once instead of a tqdm bar per file. Each
+# transfer adds the bytes it writes to shared counters, and a reporter thread
+# redraws the line every `progress_interval` seconds: items done towards the
+# target (with tqdm's ETA), combined throughput, active transfers and the bytes
+# they still expect.
+progress_interval = config.get("progress_interval", 1)
+transfer_lock = threading.Lock()
+transfer_state = {"active": 0, "bytes": 0, "pending": 0}
+transfer_stop = threading.Event()
+
+@contextmanager
+def tracked_transfer(expected):
+    transfer = {"remaining": expected}
+    with transfer_lock:
+        transfer_state["active"] += 1
+        transfer_state["pending"] += expected
+    try:
+        yield transfer
+    finally:
+        with transfer_lock:
+            transfer_state["active"] -= 1
+            transfer_state["pending"] -= max(transfer["remaining"], 0)
+
+def add_transfer_bytes(transfer, amount):
+    with transfer_lock:
+        transfer_state["bytes"] += amount
+        transfer_state["pending"] -= min(amount, max(transfer["remaining"], 0))
+        transfer["remaining"] -= amount
+
+def transfer_reporter():
+    done = progress["total_downloaded"] - target_base
+    bar = tqdm(total=max(TARGET_DOWNLOADS - done, 0), unit="item", desc="Downloading", dynamic_ncols=True)
+    shown_items = 0
+    last_bytes, last_time = 0, time.monotonic()
+    while True:
+        stopping = transfer_stop.wait(progress_interval)
+        now = time.monotonic()
+        with transfer_lock:
+            active, total_bytes, pending = (transfer_state["active"], transfer_state["bytes"],
+                                            transfer_state["pending"])
+        with metrics_lock:
+            items = counters["items_downloaded"]
+        rate = (total_bytes - last_bytes) / max(now - last_time, 1e-6)
+        last_bytes, last_time = total_bytes, now
+        eta = f"{pending / rate:.0f}s" if rate and pending else "-"
+        bar.update(items - shown_items)
+        shown_items = items
+        bar.set_postfix_str(f"{rate / 1024 / 1024:.1f} MB/s, {active} active, "
+                            f"{pending / 1024 / 1024:.1f} MB left ({eta})")
+        if stopping:
+            break
+    bar.close()
+
+def start_transfer_display():
+    thread = threading.Thread(target=transfer_reporter, name="transfer-progress", daemon=True)
+    thread.start()
+    return thread
+
+def stop_transfer_display(thread):
+    transfer_stop.set()
+    thread.join()
+
+# -----------------------------------------------------------------------------
+# FILE DOWNLOADS
+# -----------------------------------------------------------------------------
+# Media is streamed into `<file>.part` and only renamed into place once its size
+# matches what the server announced, so an interrupted download never looks
+# complete. A leftover .part file is resumed with a Range request when the server
+# honours it. Files of at least `parallel_download_min_mb` are fetched as
+# `parallel_download_parts` byte ranges at once when the server accepts ranges.
+# With parallel ranges on, a new download first asks for the first part only;
+# the 206 reply gives the full size and shows that ranges work, and the rest is
+# then fetched in parallel or, for smaller files, with one more request.
+#
+# Responses are read with readinto() into a reusable per-thread buffer of
+# `download_chunk_kb` and written from slices of it, so no chunk objects are
+# created per read. The buffer is filled in reads of at most 64 KB, and what is
+# in it is still written when the connection breaks, so a resume only has to
+# fetch again the bytes of the read that failed. Parallel ranges run on one
+# pool shared by all downloads, whose threads keep their buffers between files. With `preallocate_downloads` the file's full size is
+# reserved before the first write; since the size of such a file says nothing
+# about how much of it holds data, the written length is kept in a
+# `<file>.part.written` file next to it, refreshed every `mark_every_mb` while
+# streaming, and a .part file that still has one after a crash is cut back to
+# that length before resuming. An interrupted transfer truncates the .part
+# file back to the bytes actually written and is resumed from there, with the
+# same backoff as other requests, up to `http_retries` times. Bytes written in order from the start of the file are hashed
+# as they stream, so the content index does not read the file back; a file
+# fetched in parallel ranges or resumed from an earlier run is hashed from disk.
+download_chunk_size = config.get("download_chunk_kb", 1024) * 1024
+preallocate_downloads = config.get("preallocate_downloads", True)
+mark_every_bytes = config.get("mark_every_mb", 16) * 1024 * 1024
+parallel_download_min_bytes = config.get("parallel_download_min_mb", 64) * 1024 * 1024
+parallel_download_parts = config.get("parallel_download_parts", 4)
+parallel_first_range = -(-parallel_download_min_bytes // max(parallel_download_parts, 1))
+transfer_read_size = min(64 * 1024, download_chunk_size)
+transfer_buffers = threading.local()
+range_pool = ThreadPoolExecutor(max_workers=config.get("download_workers", 4) * max(parallel_download_parts, 1),
+                                thread_name_prefix="range")
+
+def content_total(resp):
+    # Full size of the resource, from Content-Range for partial responses
+    content_range = resp.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+    return int(resp.headers.get("Content-Length", 0))
+
+def preallocate(f, size):
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # Filesystems without fallocate support
+    f.truncate(size)
+
+def mark_written(part_path, size):
+    with open(part_path + ".written", "w") as marker:
+        marker.write(str(size))
+
+def clear_written(part_path):
+    if os.path.exists(part_path + ".written"):
+        os.remove(part_path + ".written")
+
+def resume_offset(part_path):
+    if not os.path.exists(part_path):
+        return 0
+    if os.path.exists(part_path + ".written"):
+        # Preallocated by a run that never finished it: only the recorded prefix is data
+        with open(part_path + ".written") as marker:
+            written = int(marker.read() or 0)
+        with open(part_path, "r+b") as f:
+            f.truncate(written)
+        clear_written(part_path)
+    return os.path.getsize(part_path)
+
+def stream_to_file(resp, f, transfer, checksum=None, part_path=None):
+    # With part_path, the bytes written so far are recorded for a crash resume
+    buffer = getattr(transfer_buffers, "buffer", None)
+    if buffer is None:
+        buffer = transfer_buffers.buffer = memoryview(bytearray(download_chunk_size))
+    resp.raw.decode_content = True
+    written = marked = 0
+    finished = False
+    try:
+        while not finished:
+            filled = 0
+            try:
+                while filled < len(buffer):
+                    read = resp.raw.readinto(buffer[filled:filled + transfer_read_size])
+                    if not read:
+                        finished = True
+                        break
+                    filled += read
+            finally:
+                # Also runs when the connection breaks, keeping what already arrived
+                if filled:
+                    f.write(buffer[:filled])
+                    if checksum is not None and checksum["digest"] is not None:
+                        checksum["digest"].update(buffer[:filled])
+                        checksum["bytes"] += filled
+                    written += filled
+                    add_transfer_bytes(transfer, filled)
+                if part_path and written - marked >= mark_every_bytes:
+                    f.flush()
+                    mark_written(part_path, f.tell())
+                    marked = written
+    finally:
+        count("bytes_downloaded", written)
+    return written
+
+def download_range(url, part_path, start, end, transfer):
+    resp = http_get(url, stream=True, timeout=download_timeout, governor=cdn_governor,
+                    headers={"Range": f"bytes={start}-{end}"})
+    with resp:
+        if resp.status_code != 206:
+            raise IOError(f"Range request returned status {resp.status_code}")
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            stream_to_file(resp, f, transfer)
+            if f.tell() != end + 1:
+                raise IOError(f"Range {start}-{end} ended early at byte {f.tell()}")
+
+def download_parallel(url, part_path, offset, total_size, transfer):
+    # Fetches everything after the first `offset` bytes already in the .part file
+    mark_written(part_path, offset)
+    with open(part_path, "r+b") as f:
+        preallocate(f, total_size)
+    step = -(-(total_size - offset) // parallel_download_parts)
+    ranges = [(start, min(start + step, total_size) - 1) for start in range(offset, total_size, step)]
+    log.debug(f"Fetching {len(ranges)} byte ranges in parallel")
+    futures = [range_pool.submit(download_range, url, part_path, start, end, transfer)
+               for start, end in ranges]
+    try:
+        for future in futures:
+            future.result()
+    except Exception:
+        # The other ranges must stop writing before the file is cut back
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        # Ranges written out of order cannot be resumed by size; the prefix can
+        with open(part_path, "r+b") as f:
+            f.truncate(offset)
+        raise
+    finally:
+        clear_written(part_path)
+
+def range_headers(offset):
+    if offset:
+        return {"Range": f"bytes={offset}-"}
+    if parallel_download_parts > 1:
+        return {"Range": f"bytes=0-{parallel_first_range - 1}"}
+    return {}
+
+def download_file(url, out_path):
+    # Returns the file size, ETag and SHA-256 (None if it could not be hashed
+    # while streaming), or None if the server refused the download
+    with cdn_governor.slot():
+        return fetch_file(url, out_path)
+
+def fetch_file(url, out_path):
+    checksum = {"digest": hashlib.sha256(), "bytes": 0}
+    attempt = 0
+    while True:
+        try:
+            return fetch_part(url, out_path, checksum)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            if attempt == http_retries:
+                raise
+            log.warning(f"Download of {url} interrupted ({str(e)}), resuming")
+        count("retries")
+        time.sleep(random.uniform(0, http_backoff * 2 ** attempt))
+        attempt += 1
+
+def fetch_part(url, out_path, checksum):
+    # One attempt, continuing whatever an earlier attempt left in the .part file
+    part_path = out_path + ".part"
+    offset = resume_offset(part_path)
+    resp = http_get(url, stream=True, timeout=download_timeout, governor=cdn_governor,
+                    headers=range_headers(offset))
+    if resp.status_code == 416:
+        # Stale .part file that no longer matches the remote file
+        resp.close()
+        os.remove(part_path)
+        offset = 0
+        resp = http_get(url, stream=True, timeout=download_timeout, governor=cdn_governor,
+                        headers=range_headers(0))
+    with resp:
+        if resp.status_code not in (200, 206):
+            log.error(f"Download returned status {resp.status_code}")
+            return None
+        if resp.status_code == 200 and offset:
+            log.debug("Server ignored the Range request, restarting download")
+            offset = 0
+        elif offset:
+            log.debug(f"Resuming download at byte {offset}")
+        if not offset:
+            checksum.update(digest=hashlib.sha256(), bytes=0)
+        elif offset != checksum["bytes"]:
+            # Left by an earlier run, so its first bytes were never hashed
+            checksum["digest"] = None
+
+        total_size = content_total(resp)
+        etag = resp.headers.get("ETag")
+        first_range = resp.status_code == 206 and not offset
+        with tracked_transfer(max(total_size - offset, 0)) as transfer:
+            with open(part_path, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                marked = preallocate_downloads and total_size > offset
+                if marked:
+                    mark_written(part_path, offset)
+                    preallocate(f, total_size)
+                try:
+                    stream_to_file(resp, f, transfer, checksum, part_path if marked else None)
+                finally:
+                    # Drops the unwritten part of the preallocation
+                    f.truncate(f.tell())
+                    if marked:
+                        clear_written(part_path)
+            size = os.path.getsize(part_path)
+            if first_range and size < total_size and total_size >= parallel_download_min_bytes:
+                checksum["digest"] = None
+                download_parallel(url, part_path, size, total_size, transfer)
+                size = total_size
+
+    if first_range and 0 < size < total_size:
+        # Only the first part was asked for; the rest comes with a resume request
+        return fetch_part(url, out_path, checksum)
+    if total_size and size != total_size:
+        raise IOError(f"Incomplete download: {size} of {total_size} bytes, kept {part_path} for resume")
+    os.replace(part_path, out_path)
+    return size, etag, checksum["digest"] and checksum["digest"].hexdigest()
+
+# -----------------------------------------------------------------------------
+# CONTENT INDEX
+# -----------------------------------------------------------------------------
+# Every file on disk is indexed by media ID with its size, SHA-256 and ETag. The
+# index is built by scanning the download folder once and then kept up to date
+# as files arrive. Before a download the index is consulted: a file that is
+# still on disk with its recorded size is reused, after a HEAD request confirms
+# that the remote size and ETag still match when `verify_existing_with_head` is
+# set. A new file that is byte-identical to one already indexed is replaced by
+# a hard link to it when `dedup_hardlinks` is set.
+verify_existing_with_head = config.get("verify_existing_with_head", True)
+dedup_hardlinks = config.get("dedup_hardlinks", True)
+hash_chunk_size = 1024 * 1024
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(hash_chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_download_folder():
+    # One-time indexing of files downloaded before the content index existed
+    if state_db.execute("SELECT value FROM state WHERE key = 'content_scanned'").fetchone():
+        return
+    rows = []
+    for entry in os.scandir(DOWNLOAD_FOLDER):
+        if not entry.is_file() or entry.name.endswith((".part", ".written")) or "_source." not in entry.name:
+            continue
+        media_id = entry.name.split("_source.")[0]
+        rows.append((media_id, entry.path, entry.stat().st_size, file_sha256(entry.path)))
+    with state_db:
+        state_db.executemany(
+            "INSERT OR IGNORE INTO content (media_id, path, size, sha256, etag) VALUES (?, ?, ?, ?, NULL)",
+            rows
+        )
+        state_db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('content_scanned', 1)")
+    log.info(f"Indexed {len(rows)} existing files in {DOWNLOAD_FOLDER}")
+
+def existing_download(media_id, url):
+    # Returns the path of a usable local copy of the item, or None. For an item
+    # moved into a shard that is the shard's path.
+    with state_lock:
+        row = state_db.execute("SELECT path, size, etag FROM content WHERE media_id = ?",
+                               (media_id,)).fetchone()
+        sharded = state_db.execute("SELECT shard, size, end FROM shard_index WHERE media_id = ?",
+                                   (str(media_id),)).fetchone()
+    if sharded:
+        path, size = shard_path(sharded[0]), sharded[1]
+        etag = row[2] if row else None
+        if not os.path.exists(path) or os.path.getsize(path) < sharded[2]:
+            log.debug(f"Shard {path} is missing or cut short, downloading {media_id} again")
+            return None
+    elif row:
+        path, size, etag = row
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            log.debug(f"Indexed file {path} is missing or changed, downloading again")
+            return None
+    else:
+        return None
+    if verify_existing_with_head:
+        # http_request takes the governor slot itself for a request that is not streamed
+        resp = http_head(url, governor=cdn_governor)
+        with resp:
+            if resp.status_code != 200:
+                log.debug(f"HEAD returned status {resp.status_code}, downloading again")
+                return None
+            remote_size = int(resp.headers.get("Content-Length", 0))
+            remote_etag = resp.headers.get("ETag")
+        if (remote_size and remote_size != size) or (etag and remote_etag and etag != remote_etag):
+            log.debug(f"Remote file for {media_id} changed, downloading again")
+            return None
+    count("skipped_existing")
+    return path
+
+def index_download(media_id, path, size, etag, sha256=None):
+    sha256 = sha256 or file_sha256(path)
+    with state_lock:
+        duplicate = state_db.execute(
+            "SELECT path FROM content WHERE sha256 = ? AND size = ? AND media_id != ? LIMIT 1",
+            (sha256, size, media_id)
+        ).fetchone()
+        if dedup_hardlinks and duplicate and os.path.exists(duplicate[0]) \
+                and not os.path.samefile(duplicate[0], path):
+            link_path = path + ".link"
+            try:
+                os.link(duplicate[0], link_path)
+                os.replace(link_path, path)
+                count("hardlinked")
+                log.info(f"{os.path.basename(path)} is identical to {duplicate[0]}, hard-linked")
+            except OSError as e:
+                log.warning(f"Could not hard-link {path} to {duplicate[0]} ({str(e)}), keeping the copy")
+        with state_db:
+            state_db.execute(
+                "INSERT OR REPLACE INTO content (media_id, path, size, sha256, etag) VALUES (?, ?, ?, ?, ?)",
+                (media_id, path, size, sha256, etag)
+            )
+
+# -----------------------------------------------------------------------------
+# PIPELINE STATE
+# -----------------------------------------------------------------------------
+# `browser_workers` discovery threads lease page numbers and put the items they
+# find on a bounded queue; `download_workers` threads do the API lookups and
+# media downloads. Every mutation of `progress` (and the state database behind
+# it) happens under `state_lock`. A page only counts as finished once every item
+# taken from it has been attempted; pages can finish in any order and
+# `current_page` is the lowest page not finished yet. A page where an item failed
+# for a reason that may pass (an API or transfer error, a file that did not
+# decode) is left unfinished, so its lease is reclaimed and the item retried by
+# the next run.
+download_workers = config.get("download_workers", 4)
+item_queue = queue.Queue(maxsize=config.get("queue_size", 64))
+state_lock = threading.RLock()
+stop_event = threading.Event()
+page_pending = {}
+failed_pages = set()
+queued_urls = set()
+# URL -> holders (the download worker, then post-processing) of items not done yet
+in_flight = {}
+last_page = None
+
+# "api" resolves items from the ID in the URL alone; "browser" also opens every
+# item page in a tab first, as the scraper originally did. In api mode the first
+# `latency_sample_items` items still get a timed tab visit for comparison.
+item_resolution = config.get("item_resolution", "api")
+latency_sample_items = config.get("latency_sample_items", 5)
+item_latencies = []
+visit_latencies = []
+
+# Downloads recorded before an incremental run do not count towards its target
+target_base = 0
+
+def target_reached():
+    return progress["total_downloaded"] - target_base >= TARGET_DOWNLOADS
+
+def claim_page():
+    with state_lock:
+        if crawl_mode == "incremental":
+            return claim_incremental_page()
+        return lease_page(last_page)
+
+def mark_last_page(page):
+    # Pages past the end of the listing are dropped by whoever claimed them
+    global last_page
+    with state_lock:
+        drop_lease(page + 1)
+        if last_page is None or page < last_page:
+            last_page = page
+
+def open_page(page):
+    # The extra count is held by the producer until the page is fully queued
+    with state_lock:
+        page_pending[page] = page_pending.get(page, 0) + 1
+
+def release_page(page):
+    with state_lock:
+        page_pending[page] -= 1
+        if page_pending[page]:
+            return
+        del page_pending[page]
+        if page in failed_pages:
+            failed_pages.discard(page)
+            update_progress(progress)
+            log.info(f"Page {page} had failed items, leaving it unfinished for the next run")
+            return
+        update_progress(progress, finished_page=None if crawl_mode == "incremental" else page)
+        log.debug(f"Page {page} finished, resume point is page {progress['current_page']}")
+
+def fail_page(page):
+    with state_lock:
+        failed_pages.add(page)
+
+def reserve_download(url):
+    # Keeps concurrent workers from overshooting TARGET_DOWNLOADS. An item counts
+    # as in flight until it is stored, then only towards total_downloaded.
+    with state_lock:
+        if progress["total_downloaded"] - target_base + len(in_flight) >= TARGET_DOWNLOADS:
+            return False
+        in_flight[url] = 1
+        return True
+
+def reserve_slot(url):
+    # Holds an item reserved by a worker for work that outlives the worker's turn
+    with state_lock:
+        in_flight[url] = in_flight.get(url, 0) + 1
+
+def finish_download(url):
+    with state_lock:
+        if url not in in_flight:
+            return
+        in_flight[url] -= 1
+        if not in_flight[url]:
+            del in_flight[url]
+
+def count_stored(url):
+    # Callers hold state_lock; moves the item from in flight to done
+    in_flight.pop(url, None)
+    progress["total_downloaded"] += 1
+
+# -----------------------------------------------------------------------------
+# METADATA SINK
+# -----------------------------------------------------------------------------
+# Metadata records are buffered and appended to metadata.json (one JSON object
+# per line) in batches of `metadata_flush_items` or every
+# `metadata_flush_seconds`. Each flush also commits the processed URLs of the
+# flushed records, so progress never claims an item whose metadata was lost.
+# `metadata_index` maps a media ID to the byte offset and length of its line.
+# A reused file whose record is already there only has its URL recorded.
+metadata_flush_items = config.get("metadata_flush_items", 50)
+metadata_flush_seconds = config.get("metadata_flush_seconds", 10)
+metadata_export = config.get("metadata_export", [])
+metadata_buffer = []
+known_buffer = []
+last_metadata_flush = time.monotonic()
+
+def record_media_id(item_data):
+    return str(item_data.get("video_id") or item_data.get("photo_id") or item_data.get("audio_id"))
+
+def load_metadata_index():
+    index = {row[0]: (row[1], row[2]) for row in
+             state_db.execute("SELECT media_id, offset, length FROM metadata_index")}
+    if index or not os.path.exists(metadata_file):
+        return index
+    # One-time scan of a metadata file written before the index existed
+    offset = 0
+    with open(metadata_file, "rb") as f:
+        for line in f:
+            if line.strip():
+                index[record_media_id(json.loads(line))] = (offset, len(line))
+            offset += len(line)
+    with state_db:
+        state_db.executemany(
+            "INSERT OR REPLACE INTO metadata_index (media_id, offset, length) VALUES (?, ?, ?)",
+            [(media_id, start, length) for media_id, (start, length) in index.items()]
+        )
+    log.info(f"Indexed {len(index)} existing metadata records")
+    return index
+
+metadata_index = {}
+
+def lookup_metadata(media_id):
+    entry = metadata_index.get(str(media_id))
+    if entry is None:
+        # Records flushed by other processes are only in the database
+        entry = state_db.execute("SELECT offset, length FROM metadata_index WHERE media_id = ?",
+                                 (str(media_id),)).fetchone()
+    if entry is None:
+        return None
+    with open(metadata_file, "rb") as f:
+        f.seek(entry[0])
+        record = json.loads(f.read(entry[1]))
+    # Records of files moved into shards later still name the loose file
+    record.update(shard_location(media_id) or {})
+    return record
+
+def save_metadata(item_data, url, page):
+    with state_lock:
+        metadata_buffer.append((item_data, url, page))
+        progress["processed_urls"].add(url)
+        count_stored(url)
+        if (len(metadata_buffer) + len(known_buffer) >= metadata_flush_items
+                or time.monotonic() - last_metadata_flush >= metadata_flush_seconds):
+            update_progress(progress)
+
+def save_known_item(media_id, url, page):
+    with state_lock:
+        known_buffer.append((str(media_id), url, page))
+        progress["processed_urls"].add(url)
+        count_stored(url)
+        if (len(metadata_buffer) + len(known_buffer) >= metadata_flush_items
+                or time.monotonic() - last_metadata_flush >= metadata_flush_seconds):
+            update_progress(progress)
+
+def maybe_flush_metadata():
+    with state_lock:
+        if (metadata_buffer or known_buffer) and time.monotonic() - last_metadata_flush >= metadata_flush_seconds:
+            update_progress(progress)
+
+def flush_metadata():
+    # Stages the index and processed rows; update_progress commits them.
+    # Returns how many URLs were newly recorded.
+    global last_metadata_flush
+    last_metadata_flush = time.monotonic()
+    recorded = 0
+    for media_id, url, page in known_buffer:
+        recorded += record_processed(progress, url, media_id, page)
+    known_buffer.clear()
+    if not metadata_buffer:
+        return recorded
+    entries = []
+    with open(metadata_file, "ab") as f:
+        offset = f.seek(0, os.SEEK_END)
+        for item_data, url, page in metadata_buffer:
+            line = (json.dumps(item_data) + "\n").encode("utf-8")
+            f.write(line)
+            entries.append((record_media_id(item_data), offset, len(line), url, page))
+            offset += len(line)
+    for media_id, start, length, url, page in entries:
+        metadata_index[media_id] = (start, length)
+        recorded += record_processed(progress, url, media_id, page)
+    state_db.executemany(
+        "INSERT OR REPLACE INTO metadata_index (media_id, offset, length) VALUES (?, ?, ?)",
+        [entry[:3] for entry in entries]
+    )
+    log.debug(f"Flushed {len(entries)} metadata records")
+    metadata_buffer.clear()
+    return recorded
+
+PARQUET_SCHEMA = pa.schema([
+    ("media_id", pa.string()),
+    ("page", pa.int64()),
+    ("page_link", pa.string()),
+    ("download_file", pa.string()),
+    ("download_path", pa.string()),
+    ("timestamp", pa.string()),
+    ("metadata", pa.string())
+]) if pa is not None else None
+
+def parquet_row(item_data):
+    # The API record stays a JSON string so its schema may vary between items
+    return {
+        "media_id": record_media_id(item_data),
+        "page": item_data.get("page"),
+        "page_link": item_data.get("page_link"),
+        "download_file": item_data.get("download_file"),
+        "download_path": item_data.get("download_path"),
+        "timestamp": item_data.get("timestamp"),
+        "metadata": json.dumps(item_data.get("metadata"))
+    }
+
+def export_metadata(formats):
+    base_path = os.path.splitext(metadata_file)[0]
+    if not os.path.exists(metadata_file):
+        return
+    if "ndjson.gz" in formats:
+        with open(metadata_file, "rb") as src, gzip.open(base_path + ".ndjson.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        log.info(f"Exported metadata to {base_path}.ndjson.gz")
+    if "parquet" in formats:
+        if pq is None:
+            log.error("Parquet export needs pyarrow (pip install pyarrow)")
+            return
+        writer = None
+        try:
+            with open(metadata_file, "r") as f:
+                while True:
+                    rows = [parquet_row(json.loads(line)) for line in islice(f, 10000) if line.strip()]
+                    if not rows:
+                        break
+                    table = pa.Table.from_pylist(rows, schema=PARQUET_SCHEMA)
+                    if writer is None:
+                        writer = pq.ParquetWriter(base_path + ".parquet", PARQUET_SCHEMA)
+                    writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        log.info(f"Exported metadata to {base_path}.parquet")
+
+# -----------------------------------------------------------------------------
+# SHARDED OUTPUT
+# -----------------------------------------------------------------------------
+# With `output_mode` "shards" every download is appended to a tar shard in the
+# WebDataset layout, `<id>.jpg` or `<id>.mp4` followed by `<id>.json` with its
+# metadata record, and the loose file is removed. A shard is closed once it
+# would grow past `shard_max_mb`. The shard_index table maps each media ID to
+# its shard and the byte offsets of both members, and is exported to
+# shards/index.jsonl at the end of a run. After a crash the newest shard is cut
+# back to the end of its last indexed item. Files already in the download
+# folder are converted into shards when the scraper starts in this mode. An
+# item in a shard counts as already downloaded in either output mode, and
+# lookup_metadata reports its shard location.
+output_mode = config.get("output_mode", "files")
+shard_max_bytes = config.get("shard_max_mb", 1024) * 1024 * 1024
+shard_copy_chunk = 1024 * 1024
+shard_lock = threading.Lock()
+shard_file = None
+shard_number = 0
+shard_end = 0
+
+def shard_path(number):
+    return os.path.join(SHARD_FOLDER, f"{content_type}-{number:06d}.tar")
+
+def shard_location(media_id):
+    # The download_file/download_path/shard_offset fields of a sharded item
+    with state_lock:
+        row = state_db.execute("SELECT shard, member, offset FROM shard_index WHERE media_id = ?",
+                               (str(media_id),)).fetchone()
+    if row is None:
+        return None
+    return {"download_file": row[1], "download_path": shard_path(row[0]), "shard_offset": row[2]}
+
+def open_shard(number, end):
+    global shard_file, shard_number, shard_end
+    os.makedirs(SHARD_FOLDER, exist_ok=True)
+    path = shard_path(number)
+    shard_file = open(path, "r+b" if os.path.exists(path) else "w+b")
+    shard_number, shard_end = number, end
+    # Drops a partly written item and rewrites the end-of-archive blocks
+    shard_file.seek(end)
+    shard_file.write(b"\0" * 2 * tarfile.BLOCKSIZE)
+    shard_file.truncate()
+    shard_file.flush()
+    log.debug(f"Writing to shard {path} from byte {end}")
+
+def resume_shard():
+    row = state_db.execute(
+        "SELECT shard, MAX(end) FROM shard_index GROUP BY shard ORDER BY shard DESC LIMIT 1"
+    ).fetchone()
+    open_shard(*(row or (0, 0)))
+
+def close_shard():
+    global shard_file
+    with shard_lock:
+        if shard_file is not None:
+            shard_file.close()
+            shard_file = None
+
+def write_tar_member(name, size, source):
+    # Returns the offset of the member's data within the shard
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    shard_file.write(info.tobuf(tarfile.USTAR_FORMAT))
+    data_offset = shard_file.tell()
+    shutil.copyfileobj(source, shard_file, shard_copy_chunk)
+    shard_file.write(b"\0" * (-size % tarfile.BLOCKSIZE))
+    return data_offset
+
+def write_to_shard(media_id, path, item_data, extra_files=()):
+    # Moves the downloaded file, and any (member, path) extras such as
+    # thumbnails, into the current shard and points item_data at it
+    global shard_end
+    member = f"{media_id}{os.path.splitext(path)[1]}"
+    with shard_lock:
+        if shard_file is None:
+            resume_shard()
+        with state_lock:
+            row = state_db.execute("SELECT shard, offset FROM shard_index WHERE media_id = ?",
+                                   (str(media_id),)).fetchone()
+        if row:
+            # Written before a crash that lost the metadata; keep the first copy
+            log.debug(f"{member} is already in shard {row[0]}")
+            item_data.update(download_file=member, download_path=shard_path(row[0]), shard_offset=row[1])
+            for extra_path in [path] + [extra_path for _, extra_path in extra_files]:
+                os.remove(extra_path)
+            return
+        size = os.path.getsize(path) + sum(os.path.getsize(extra_path) for _, extra_path in extra_files)
+        if shard_end and shard_end + size > shard_max_bytes:
+            shard_file.close()
+            open_shard(shard_number + 1, 0)
+            log.info(f"Started shard {shard_path(shard_number)}")
+        item_data.update(download_file=member, download_path=shard_path(shard_number))
+        shard_file.seek(shard_end)
+        # The data offset is known once the member header is written
+        header_size = len(tarfile.TarInfo(member).tobuf(tarfile.USTAR_FORMAT))
+        item_data["shard_offset"] = shard_end + header_size
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            offset = write_tar_member(member, size, f)
+        for extra_member, extra_path in extra_files:
+            with open(extra_path, "rb") as f:
+                write_tar_member(extra_member, os.path.getsize(extra_path), f)
+        record = json.dumps(item_data).encode("utf-8")
+        meta_offset = write_tar_member(f"{media_id}.json", len(record), io.BytesIO(record))
+        shard_end = shard_file.tell()
+        shard_file.write(b"\0" * 2 * tarfile.BLOCKSIZE)
+        shard_file.flush()
+        with state_lock, state_db:
+            state_db.execute(
+                "INSERT INTO shard_index (media_id, shard, member, offset, size, meta_offset, meta_size, end) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(media_id), shard_number, member, offset, size, meta_offset, len(record), shard_end)
+            )
+    for extra_path in [path] + [extra_path for _, extra_path in extra_files]:
+        os.remove(extra_path)
+
+def convert_to_shards():
+    # Moves loose files from earlier runs into shards, with their metadata records
+    names = [name for name in os.listdir(DOWNLOAD_FOLDER)
+             if "_source." in name and not name.endswith((".part", ".written"))]
+    if not names:
+        return
+    log.info(f"Converting {len(names)} files in {DOWNLOAD_FOLDER} into shards")
+    id_key = {"photos": "photo_id", "videos": "video_id", "music": "audio_id"}[content_type]
+    for name in tqdm(sorted(names), desc="Converting", unit="file"):
+        media_id = name.split("_source.")[0]
+        item_data = lookup_metadata(media_id) or {id_key: media_id}
+        with timed("shard_write"):
+            write_to_shard(media_id, os.path.join(DOWNLOAD_FOLDER, name), item_data)
+    log.info(f"Converted {len(names)} files, the last shard is {shard_path(shard_number)}")
+
+def export_shard_index():
+    rows = state_db.execute(
+        "SELECT media_id, shard, member, offset, size, meta_offset, meta_size FROM shard_index "
+        "ORDER BY shard, offset"
+    ).fetchall()
+    os.makedirs(SHARD_FOLDER, exist_ok=True)
+    with open(SHARD_INDEX_FILE + ".tmp", "w") as f:
+        for media_id, shard, member, offset, size, meta_offset, meta_size in rows:
+            f.write(json.dumps({
+                "key": media_id,
+                "shard": os.path.basename(shard_path(shard)),
+                "member": member,
+                "offset": offset,
+                "size": size,
+                "json_offset": meta_offset,
+                "json_size": meta_size
+            }))
+            f.write("\n")
+    os.replace(SHARD_INDEX_FILE + ".tmp", SHARD_INDEX_FILE)
+    log.info(f"Exported the shard index for {len(rows)} items to {SHARD_INDEX_FILE}")
+
+# -----------------------------------------------------------------------------
+# ITEM PAGE VISIT
+# -----------------------------------------------------------------------------
+def visit_item_page(driver, url):
+    # Runs on the browser thread; the download itself is left to the workers
+    visit_start = time.perf_counter()
+    try:
+        driver.execute_script(f"window.open('{url}');")
+        driver.switch_to.window(driver.window_handles[1])
+        time.sleep(3)
+    finally:
+        if len(driver.window_handles) > 1:
+            driver.close()
+            driver.switch_to.window(driver.window_handles[0])
+        visit_latencies.append(time.perf_counter() - visit_start)
+
+def should_visit_item_page():
+    return item_resolution == "browser" or len(visit_latencies) < latency_sample_items
+
+def report_item_latency():
+    if not item_latencies:
+        return
+    resolve_avg = statistics.mean(item_latencies)
+    log.info(f"Per-item latency without tab visit: {resolve_avg:.2f}s avg, "
+             f"{statistics.median(item_latencies):.2f}s median over {len(item_latencies)} items")
+    if visit_latencies:
+        visit_avg = statistics.mean(visit_latencies)
+        log.info(f"Per-item latency with tab visit: {resolve_avg + visit_avg:.2f}s avg "
+                 f"(tab visit adds {visit_avg:.2f}s, measured on {len(visit_latencies)} items)")
+
+# -----------------------------------------------------------------------------
+# AUDIO ITEM PAGES
+# -----------------------------------------------------------------------------
+# Music files are only handed out through the download button on a track's
+# page. The browser runs behind selenium-wire with its capture scoped to the
+# audio CDN: clicking through to the download records that one request, the
+# interceptor stops the browser from fetching the file, and the URL is passed
+# to the download workers. Captured requests are cleared after every track so
+# the capture buffer never grows with the session.
+AUDIO_CDN_PATTERN = r"cdn\.pixabay\.com/download/audio"
+audio_capture_timeout = config.get("audio_capture_timeout", 30)
+
+def stop_audio_download(request):
+    # Only called for in-scope requests, i.e. the audio file itself
+    request.abort()
+
+def resolve_audio_item(driver, url):
+    driver.execute_script("window.open('');")
+    driver.switch_to.window(driver.window_handles[1])
+    try:
+        driver.get(url)
+        title = wait_for_element(driver, By.CLASS_NAME, "title--VRujt").text
+        credits = wait_for_element(driver, By.CLASS_NAME, "userName--owby3").get_attribute("href")
+        tags = [tag.text for section in driver.find_elements(By.CLASS_NAME, "tagsSection--8gH54")
+                for tag in section.find_elements(By.CLASS_NAME, "label--Ngqjq")]
+
+        side_panel = wait_for_element(driver, By.CLASS_NAME, "sidePanel--XFASR")
+        driver.execute_script("arguments[0].scrollIntoView();", side_panel)
+        del driver.requests
+        side_panel.find_element(By.CLASS_NAME, "triggerWrapper--NACCC").find_element(By.TAG_NAME, "button").click()
+        wait_for_element(driver, By.CLASS_NAME, "buttons--cqw3Y").find_element(By.CLASS_NAME, "label--Ngqjq").click()
+        audio_url = driver.wait_for_request(AUDIO_CDN_PATTERN, timeout=audio_capture_timeout).url
+    finally:
+        del driver.requests
+        if len(driver.window_handles) > 1:
+            driver.close()
+            driver.switch_to.window(driver.window_handles[0])
+    log.debug(f"Captured audio URL: {audio_url}")
+    return {
+        "title": title,
+        "credits": credits,
+        "tags": tags,
+        "audio_url": audio_url,
+        "file_name": unquote(audio_url.split("filename=")[-1]) if "filename=" in audio_url else None
+    }
+
+# -----------------------------------------------------------------------------
+# POST-PROCESSING
+# -----------------------------------------------------------------------------
+# With `postprocess` on, every stored file goes through a process pool that
+# reads it once to hash it, decode it fully (photos, with Pillow) and write a
+# JPEG thumbnail for each size in `thumbnail_sizes` (longest edge in pixels).
+# Videos only get their MP4 signature checked since there is no video decoder,
+# and music is only hashed.
+# The download worker moves on to the next item while the pool works; the
+# item's page and download slot stay held until the pool's callback stores the
+# results in the metadata record. Files that fail to decode are deleted and
+# left unrecorded, and their page is left unfinished so the next run fetches
+# them again.
+postprocess = config.get("postprocess", False)
+postprocess_workers = config.get("postprocess_workers") or os.cpu_count()
+thumbnail_sizes = config.get("thumbnail_sizes", [256])
+thumbnail_quality = config.get("thumbnail_quality", 85)
+postprocess_pool = None
+postprocess_lock = threading.Lock()
+# Bounds the files waiting for the pool so downloads cannot run far ahead
+postprocess_slots = threading.BoundedSemaphore(2 * postprocess_workers)
+
+def ignore_sigint():
+    # Ctrl+C is handled by the main process, which drains the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def postprocess_file(path, kind, media_id, sizes, folder, quality):
+    # Runs in a pool worker; returns the check results and thumbnail paths
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    result = {"valid": None, "thumbnails": {}}
+    if kind != "photos":
+        with open(path, "rb") as f:
+            head = f.read(12)
+            digest.update(head)
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        if kind == "videos":
+            result["valid"] = head[4:8] == b"ftyp"
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+        digest.update(data)
+        if Image is not None:
+            try:
+                with Image.open(io.BytesIO(data)) as image:
+                    image.load()
+                    result.update(valid=True, width=image.width, height=image.height, format=image.format)
+                    for size in sizes:
+                        thumb = image.convert("RGB")
+                        thumb.thumbnail((size, size))
+                        thumb_path = os.path.join(folder, f"{media_id}_{size}.jpg")
+                        thumb.save(thumb_path, "JPEG", quality=quality)
+                        result["thumbnails"][str(size)] = thumb_path
+            except Exception as e:
+                result.update(valid=False, error=str(e))
+    result["sha256"] = digest.hexdigest()
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def start_postprocess():
+    # Called before any other thread exists, where forking the workers is safe
+    global postprocess_pool
+    if not postprocess:
+        return
+    os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+    if content_type == "photos" and Image is None:
+        log.warning("Pillow is not installed, photos are hashed but not decoded or thumbnailed")
+    postprocess_pool = ProcessPoolExecutor(max_workers=postprocess_workers, initializer=ignore_sigint)
+    # Starts the workers now rather than from a download thread
+    postprocess_pool.submit(time.sleep, 0).result()
+    log.debug(f"Started {postprocess_workers} post-processing workers")
+
+def restart_postprocess(broken):
+    # A worker killed mid-task (say by the OOM killer) breaks the whole pool.
+    # Other threads run by now, so the new workers are spawned, not forked.
+    global postprocess_pool
+    with postprocess_lock:
+        if postprocess_pool is not broken:
+            return
+        log.warning("Post-processing pool broke, starting a new one")
+        broken.shutdown(wait=False)
+        postprocess_pool = ProcessPoolExecutor(max_workers=postprocess_workers, initializer=ignore_sigint,
+                                               mp_context=multiprocessing.get_context("spawn"))
+
+def stop_postprocess():
+    # Waits for queued files; their callbacks run before this returns
+    if postprocess_pool is not None:
+        postprocess_pool.shutdown(wait=True)
+        log.debug("Post-processing workers stopped")
+
+def store_item(media_id, url, page, path, item_data, downloaded, result=None):
+    # downloaded is (size, etag, sha256) for a fresh download and None for a reused file
+    extra_files = []
+    if result is not None:
+        thumbnails = result["thumbnails"]
+        if output_mode == "shards":
+            extra_files = [(f"{media_id}.thumb{size}.jpg", thumb_path) for size, thumb_path in thumbnails.items()]
+            thumbnails = {size: f"{media_id}.thumb{size}.jpg" for size in thumbnails}
+        item_data["postprocess"] = {key: value for key, value in result.items() if key != "seconds"}
+        item_data["postprocess"]["thumbnails"] = thumbnails
+    if downloaded is not None and output_mode != "shards":
+        with timed("content_index"):
+            size, etag, sha256 = downloaded
+            index_download(media_id, path, size, etag, sha256=sha256 or (result and result["sha256"]))
+    location = shard_location(media_id) if downloaded is None else None
+    if location:
+        # Reused from a shard, which already holds the file
+        item_data.update(location)
+    elif output_mode == "shards":
+        with timed("shard_write"):
+            write_to_shard(media_id, path, item_data, extra_files)
+    with timed("metadata"):
+        with state_lock:
+            known = downloaded is None and lookup_metadata(media_id) is not None
+        if known:
+            save_known_item(media_id, url, page)
+        else:
+            save_metadata(item_data, url, page)
+    count("items_downloaded")
+    log.debug(f"Buffered metadata for {media_id}")
+
+def submit_postprocess(media_id, url, page, path, item_data, downloaded):
+    if downloaded is None and shard_location(media_id):
+        # Checked before it went into the shard; the pool reads loose files only
+        store_item(media_id, url, page, path, item_data, downloaded)
+        return
+    postprocess_slots.acquire()
+    # Held like a download in progress until the callback has stored the item
+    reserve_slot(url)
+    open_page(page)
+    pool = postprocess_pool
+    try:
+        future = pool.submit(postprocess_file, path, content_type, media_id, thumbnail_sizes,
+                             THUMBNAIL_FOLDER, thumbnail_quality)
+    except Exception as e:
+        postprocess_slots.release()
+        finish_download(url)
+        release_page(page)
+        if isinstance(e, BrokenProcessPool):
+            restart_postprocess(pool)
+        raise
+    future.add_done_callback(
+        lambda done: finish_postprocess(done, media_id, url, page, path, item_data, downloaded)
+    )
+
+def finish_postprocess(future, media_id, url, page, path, item_data, downloaded):
+    try:
+        result = future.result()
+        add_stage_time("postprocess", result["seconds"])
+        if result["valid"] is False:
+            log.error(f"{os.path.basename(path)} could not be decoded ({result.get('error', 'bad signature')}), "
+                      f"deleting it")
+            count_failure("invalid_media")
+            fail_page(page)
+            for bad_path in [path] + list(result["thumbnails"].values()):
+                os.remove(bad_path)
+            return
+        store_item(media_id, url, page, path, item_data, downloaded, result)
+    except Exception as e:
+        log.error(f"Post-processing failed for {media_id}: {str(e)}")
+        count_failure("postprocess_error")
+        fail_page(page)
+    finally:
+        postprocess_slots.release()
+        finish_download(url)
+        release_page(page)
+
 # -----------------------------------------------------------------------------
 # VIDEO PROCESSING
 # -----------------------------------------------------------------------------
-def process_video(url):
+def process_video(url, page, info=None):
     log.info(f"Started processing video URL: {url}")
     if url in progress["processed_urls"]:
         log.info("Skipping already processed URL")
         return False
-    
+
     try:
-        # Open new tab and wait for load
-        driver.execute_script(f"window.open('{url}');")
-        driver.switch_to.window(driver.window_handles[1])
-        time.sleep(3)
-        video_id = url.rstrip("/").split("-")[-1]
+        video_id = media_id_from_url(url)
         log.debug(f"Extracted video ID: {video_id}")
 
-        # Call Pixabay API for video metadata
-        api_url = f"https://pixabay.com/api/videos/?key={API_KEY}&id={video_id}"
-        log.debug(f"Requesting API: {api_url}")
-        resp = requests.get(api_url)
-        if resp.status_code != 200:
-            log.error("API call failed")
-            return False
+        if info is None:
+            # Call Pixabay API for video metadata
+            api_url = f"{API_URL}?key={API_KEY}&id={video_id}"
+            log.debug(f"Requesting API: {api_url}")
+            with timed("api_lookup"):
+                resp = http_get(api_url)
+            if resp.status_code != 200:
+                log.error("API call failed")
+                count_failure(f"api_status_{resp.status_code}")
+                fail_page(page)
+                return False
 
-        data = resp.json()
-        if not data.get("hits"):
-            log.error("No video data returned from API")
-            return False
+            data = resp.json()
+            if not data.get("hits"):
+                log.error("No video data returned from API")
+                count_failure("api_no_hits")
+                return False
+
+            video_info = data["hits"][0]
+            log.info("Video info retrieved from API successfully")
+        else:
+            video_info = info
+            log.debug("Using video info from search results")
 
-        video_info = data["hits"][0]
-        log.info("Video info retrieved from API successfully")
-        
         # Download the highest resolution video file
         # Select proper video resolution variant
         variants = video_info.get("videos", {})
@@ -143,201 +1876,634 @@ def process_video(url):
                 break
         if not selected_variant:
             log.error("No suitable resolution found (skipping video)")
+            count_failure("no_suitable_variant")
             return False
         highest_url = selected_variant["url"]
         log.debug(f"Selected resolution URL: {highest_url}")
-        
-        video_resp = requests.get(highest_url, stream=True)
-        if video_resp.status_code == 200:
-            file_name = f"{video_id}_source.mp4"
-            out_path = os.path.join(DOWNLOAD_FOLDER, file_name)
-            
-            total_size = int(video_resp.headers.get("Content-Length", 0))
-            # Use tqdm progress bar if total_size is known
-            if total_size:
-                progress_bar = tqdm(total=total_size, unit="B", unit_scale=True, desc="Downloading")
-            else:
-                progress_bar = None
-
-            with open(out_path, "wb") as f:
-                for chunk in video_resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        if progress_bar:
-                            progress_bar.update(len(chunk))
-            if progress_bar:
-                progress_bar.close()
 
+        file_name = f"{video_id}_source.mp4"
+        out_path = os.path.join(DOWNLOAD_FOLDER, file_name)
+        with timed("existing_check"):
+            existing_path = existing_download(video_id, highest_url)
+        if existing_path:
+            out_path = existing_path
+            file_name = os.path.basename(existing_path)
+            downloaded = None
+            log.info(f"Video file already on disk: {file_name}")
+        else:
+            with timed("download"):
+                downloaded = download_file(highest_url, out_path)
+            if downloaded is None:
+                log.error("Video download failed")
+                count_failure("download_status")
+                fail_page(page)
+                return False
             log.info(f"Downloaded video file: {file_name}")
 
-            # Prepare and save metadata
-            item_data = {
-                "page": progress["current_page"],
-                "page_link": url,
-                "video_id": video_id,
-                "download_file": file_name,
-                "download_path": out_path,
-                "metadata": video_info,
-                "timestamp": datetime.now().isoformat()
-            }
-            with open(metadata_file, "a") as f:
-                f.write(json.dumps(item_data))
-                f.write("\n")
-            log.debug("Appended video metadata to file")
-
-            # Update progress data
-            progress["processed_urls"].append(url)
-            progress["total_downloaded"] += 1
-            log.info(f"Processed {progress['total_downloaded']} videos so far")
-            return True
+        # Prepare and save metadata
+        item_data = {
+            "page": page,
+            "page_link": url,
+            "video_id": video_id,
+            "download_file": file_name,
+            "download_path": out_path,
+            "metadata": video_info,
+            "timestamp": datetime.now().isoformat()
+        }
+        if postprocess_pool is not None:
+            submit_postprocess(video_id, url, page, out_path, item_data, downloaded)
         else:
-            log.error("Video download failed")
-            return False
+            store_item(video_id, url, page, out_path, item_data, downloaded)
+        log.info(f"Processed {progress['total_downloaded']} videos so far")
+        return True
     except Exception as e:
         log.error(f"Error processing video URL: {str(e)}")
+        count_failure(type(e).__name__)
+        fail_page(page)
         return False
-    finally:
-        if len(driver.window_handles) > 1:
-            driver.close()
-            driver.switch_to.window(driver.window_handles[0])
-        update_progress(progress)
 
 # -----------------------------------------------------------------------------
 # PHOTO PROCESSING
 # -----------------------------------------------------------------------------
-def process_photo(url):
+def process_photo(url, page, info=None):
     log.info(f"Started processing photo URL: {url}")
     if url in progress["processed_urls"]:
         log.info("Skipping already processed URL")
         return False
-    
+
     try:
-        driver.execute_script(f"window.open('{url}');")
-        driver.switch_to.window(driver.window_handles[1])
-        time.sleep(3)
-        photo_id = url.rstrip("/").split("-")[-1]
+        photo_id = media_id_from_url(url)
         log.debug(f"Extracted photo ID: {photo_id}")
 
-        api_url = f"https://pixabay.com/api/?key={API_KEY}&id={photo_id}"
-        log.debug(f"Requesting API: {api_url}")
-        resp = requests.get(api_url)
-        if resp.status_code != 200:
-            log.error("API call failed")
-            return False
+        if info is None:
+            api_url = f"{API_URL}?key={API_KEY}&id={photo_id}"
+            log.debug(f"Requesting API: {api_url}")
+            with timed("api_lookup"):
+                resp = http_get(api_url)
+            if resp.status_code != 200:
+                log.error("API call failed")
+                count_failure(f"api_status_{resp.status_code}")
+                fail_page(page)
+                return False
 
-        data = resp.json()
-        if not data.get("hits"):
-            log.error("No photo data returned from API")
-            return False
+            data = resp.json()
+            if not data.get("hits"):
+                log.error("No photo data returned from API")
+                count_failure("api_no_hits")
+                return False
+
+            photo_info = data["hits"][0]
+            log.info("Photo info retrieved from API successfully")
+        else:
+            photo_info = info
+            log.debug("Using photo info from search results")
 
-        photo_info = data["hits"][0]
-        log.info("Photo info retrieved from API successfully")
-        
         # Choose high resolution image - prefer largeImageURL, fallback to webformatURL
         # or photo_info.get("webformatURL") #! Removed WebformatURL Functionality
         image_url = photo_info.get("largeImageURL")
         if not image_url:
             log.error("No suitable image URL found (skipping photo)")
+            count_failure("no_suitable_variant")
             return False
         log.debug(f"Selected image URL: {image_url}")
-        
-        image_resp = requests.get(image_url, stream=True)
-        if image_resp.status_code == 200:
-            file_name = f"{photo_id}_source.jpg"
-            out_path = os.path.join(DOWNLOAD_FOLDER, file_name)
-            
-            total_size = int(image_resp.headers.get("Content-Length", 0))
-            progress_bar = tqdm(total=total_size, unit="B", unit_scale=True, desc="Downloading") if total_size else None
-
-            with open(out_path, "wb") as f:
-                for chunk in image_resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        if progress_bar:
-                            progress_bar.update(len(chunk))
-            if progress_bar:
-                progress_bar.close()
 
+        file_name = f"{photo_id}_source.jpg"
+        out_path = os.path.join(DOWNLOAD_FOLDER, file_name)
+        with timed("existing_check"):
+            existing_path = existing_download(photo_id, image_url)
+        if existing_path:
+            out_path = existing_path
+            file_name = os.path.basename(existing_path)
+            downloaded = None
+            log.info(f"Photo file already on disk: {file_name}")
+        else:
+            with timed("download"):
+                downloaded = download_file(image_url, out_path)
+            if downloaded is None:
+                log.error("Photo download failed")
+                count_failure("download_status")
+                fail_page(page)
+                return False
             log.info(f"Downloaded photo file: {file_name}")
 
-            item_data = {
-                "page": progress["current_page"],
-                "page_link": url,
-                "photo_id": photo_id,
-                "download_file": file_name,
-                "download_path": out_path,
-                "metadata": photo_info,
-                "timestamp": datetime.now().isoformat()
-            }
-            with open(metadata_file, "a") as f:
-                f.write(json.dumps(item_data))
-                f.write("\n")
-            log.debug("Appended photo metadata to file")
-
-            progress["processed_urls"].append(url)
-            progress["total_downloaded"] += 1
-            log.info(f"Processed {progress['total_downloaded']} photos so far")
-            return True
+        item_data = {
+            "page": page,
+            "page_link": url,
+            "photo_id": photo_id,
+            "download_file": file_name,
+            "download_path": out_path,
+            "metadata": photo_info,
+            "timestamp": datetime.now().isoformat()
+        }
+        if postprocess_pool is not None:
+            submit_postprocess(photo_id, url, page, out_path, item_data, downloaded)
         else:
-            log.error("Photo download failed")
-            return False
+            store_item(photo_id, url, page, out_path, item_data, downloaded)
+        log.info(f"Processed {progress['total_downloaded']} photos so far")
+        return True
     except Exception as e:
         log.error(f"Error processing photo URL: {str(e)}")
+        count_failure(type(e).__name__)
+        fail_page(page)
         return False
-    finally:
-        if len(driver.window_handles) > 1:
-            driver.close()
-            driver.switch_to.window(driver.window_handles[0])
-        update_progress(progress)
 
 # -----------------------------------------------------------------------------
-# MAIN SCRAPING LOOP
+# AUDIO PROCESSING
 # -----------------------------------------------------------------------------
-def main():
+def process_audio(url, page, info):
+    log.info(f"Started processing audio URL: {url}")
+    if url in progress["processed_urls"]:
+        log.info("Skipping already processed URL")
+        return False
+
     try:
-        while progress["total_downloaded"] < TARGET_DOWNLOADS:
-            page = progress["current_page"]
-            log.info(f"Processing page {page}")
-            driver.get(BASE_URL.format(page))
-            
-            if content_type == "videos":
-                input("Press Enter after you have logged in. [Enter]")
+        audio_id = media_id_from_url(url)
+        log.debug(f"Extracted audio ID: {audio_id}")
 
-            # Scroll to load all items
-            last_height = driver.execute_script("return document.body.scrollHeight")
-            while True:
-                driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                time.sleep(download_delay)
-                new_height = driver.execute_script("return document.body.scrollHeight")
-                if new_height == last_height:
-                    log.debug("Reached end of page scrolling")
-                    break
-                last_height = new_height
-
-            links = [el.get_attribute("href")
-                    for el in driver.find_elements(By.CSS_SELECTOR, "a.link--WHWzm")]
-            log.info(f"Found {len(links)} links on page {page}")
-            
-            for url in links:
-                if url in progress["processed_urls"]:
-                    continue
-                if progress["total_downloaded"] >= TARGET_DOWNLOADS:
-                    log.info("Reached target download count")
-                    break
+        audio_url = info["audio_url"]
+        extension = os.path.splitext(info["file_name"] or "")[1] or ".mp3"
+        file_name = f"{audio_id}_source{extension}"
+        out_path = os.path.join(DOWNLOAD_FOLDER, file_name)
+        with timed("existing_check"):
+            existing_path = existing_download(audio_id, audio_url)
+        if existing_path:
+            out_path = existing_path
+            file_name = os.path.basename(existing_path)
+            downloaded = None
+            log.info(f"Audio file already on disk: {file_name}")
+        else:
+            with timed("download"):
+                downloaded = download_file(audio_url, out_path)
+            if downloaded is None:
+                log.error("Audio download failed")
+                count_failure("download_status")
+                fail_page(page)
+                return False
+            log.info(f"Downloaded audio file: {file_name}")
+
+        item_data = {
+            "page": page,
+            "page_link": url,
+            "audio_id": audio_id,
+            "download_file": file_name,
+            "download_path": out_path,
+            "metadata": info,
+            "timestamp": datetime.now().isoformat()
+        }
+        if postprocess_pool is not None:
+            submit_postprocess(audio_id, url, page, out_path, item_data, downloaded)
+        else:
+            store_item(audio_id, url, page, out_path, item_data, downloaded)
+        log.info(f"Processed {progress['total_downloaded']} audio tracks so far")
+        return True
+    except Exception as e:
+        log.error(f"Error processing audio URL: {str(e)}")
+        count_failure(type(e).__name__)
+        fail_page(page)
+        return False
+
+# -----------------------------------------------------------------------------
+# DOWNLOAD WORKERS
+# -----------------------------------------------------------------------------
+def download_worker():
+    while True:
+        try:
+            item = item_queue.get(timeout=1)
+        except queue.Empty:
+            # After an interrupt no sentinel may come; the queue was dropped instead
+            if stop_event.is_set():
+                return
+            continue
+        try:
+            if item is None:
+                return
+            url, page, info = item
+            # Items skipped because of shutdown or the target keep their page open
+            if stop_event.is_set():
+                log.debug(f"Shutting down, leaving {url} for the next run")
+                continue
+            if not reserve_download(url):
+                log.info(f"Target is covered by downloads in progress, leaving {url} for the next run")
+                continue
+            try:
+                item_start = time.perf_counter()
                 if content_type == "videos":
-                    if process_video(url):
-                        log.info(f"Progress: {progress['total_downloaded']}/{TARGET_DOWNLOADS}")
+                    done = process_video(url, page, info)
+                elif content_type == "music":
+                    done = process_audio(url, page, info)
                 else:
-                    if process_photo(url):
-                        log.info(f"Progress: {progress['total_downloaded']}/{TARGET_DOWNLOADS}")
-            
-            progress["current_page"] += 1
-            update_progress(progress)
+                    done = process_photo(url, page, info)
+                if done:
+                    item_latencies.append(time.perf_counter() - item_start)
+                    log.info(f"Progress: {progress['total_downloaded']}/{TARGET_DOWNLOADS}")
+            finally:
+                finish_download(url)
+                release_page(page)
+        except Exception as e:
+            log.error(f"Download worker error: {str(e)}")
+        finally:
+            item_queue.task_done()
+
+def start_workers():
+    workers = []
+    for i in range(download_workers):
+        worker = threading.Thread(target=download_worker, name=f"download-{i + 1}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    log.debug(f"Started {len(workers)} download workers")
+    return workers
+
+def stop_workers(workers):
+    # Lets the workers finish the queue. Ctrl+C meanwhile drops the queued items,
+    # whose pages stay unfinished, and only waits for the downloads in progress.
+    try:
+        for _ in workers:
+            item_queue.put(None)
+        for worker in workers:
+            # Joined with a timeout so Ctrl+C still reaches this thread
+            while worker.is_alive():
+                worker.join(timeout=1)
+    except KeyboardInterrupt:
+        log.warning("Interrupted, dropping queued items and waiting for active downloads to finish")
+        stop_event.set()
+        while True:
+            try:
+                item_queue.get_nowait()
+            except queue.Empty:
+                break
+            item_queue.task_done()
+        for worker in workers:
+            worker.join()
+    log.debug("Download workers stopped")
+
+# -----------------------------------------------------------------------------
+# API RESPONSE CACHE
+# -----------------------------------------------------------------------------
+# Search responses are cached on disk per query and page so restarts and re-runs
+# do not spend API quota again. Entries older than `api_cache_ttl_hours` are
+# refetched and the least recently used ones are evicted once the cache grows
+# beyond `api_cache_max_mb`.
+api_cache_ttl = config.get("api_cache_ttl_hours", 24) * 3600
+api_cache_max_bytes = config.get("api_cache_max_mb", 256) * 1024 * 1024
+
+def api_cache_path(params):
+    query = urlencode(sorted(params.items()))
+    digest = hashlib.sha1(f"{API_URL}?{query}".encode("utf-8")).hexdigest()
+    return os.path.join(API_CACHE_FOLDER, f"{digest}.json")
+
+def read_api_cache(params):
+    path = api_cache_path(params)
+    try:
+        if time.time() - os.path.getmtime(path) > api_cache_ttl:
+            log.debug("Cached API response expired")
+            return None
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Access time drives eviction; mtime still records when it was fetched
+    os.utime(path, (time.time(), os.path.getmtime(path)))
+    return data
+
+def write_api_cache(params, data):
+    path = api_cache_path(params)
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+    evict_api_cache()
+
+def evict_api_cache():
+    # Other threads and processes write and evict in the same folder, so
+    # entries can vanish at any point; half-written .tmp files are not counted
+    entries = []
+    for name in os.listdir(API_CACHE_FOLDER):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(API_CACHE_FOLDER, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= api_cache_max_bytes:
+            break
+        try:
+            os.remove(path)
+            log.debug(f"Evicted cached API response: {path}")
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# -----------------------------------------------------------------------------
+# PAGE HARVESTING
+# -----------------------------------------------------------------------------
+# "browser" walks the listing pages in Firefox and yields page links; "api_search"
+# pages through the search endpoint instead, `api_per_page` hits at a time, and
+# hands the hits to the workers so no per-item lookup is needed. The listing
+# pages are sorted by Editor's Choice (order=ec), which the API expresses as the
+# editors_choice filter. An incremental crawl walks the same listing from page 1.
+harvest_mode = config.get("harvest_mode", "browser")
+api_per_page = config.get("api_per_page", 200)
+SEARCH_PARAMS = {"editors_choice": "true", "order": "popular"}
+
+# Listing pages load more items as they are scrolled. Instead of sleeping a fixed
+# time after each scroll, the harvester polls the page until its height or link
+# count changes and gives up after `download_delay` seconds without new content.
+# All hrefs and IDs are then read in a single script call.
+# Music listings use their own link class (see select_content_type)
+LINK_SELECTOR = "a.link--WHWzm"
+SCROLL_SCRIPT = """
+window.scrollTo(0, document.body.scrollHeight);
+return [document.body.scrollHeight, document.querySelectorAll(arguments[0]).length];
+"""
+PAGE_STATE_SCRIPT = """
+return [document.body.scrollHeight, document.querySelectorAll(arguments[0]).length];
+"""
+# Tells a listing that loaded and has no items (the end of the listing) apart
+# from one that is still loading or was replaced by a bot challenge
+LISTING_LOADED_SCRIPT = """
+return document.readyState === "complete"
+    && !document.querySelector("iframe[src*='challenges.cloudflare.com'], #challenge-form")
+    && !/just a moment/i.test(document.title);
+"""
+HARVEST_SCRIPT = """
+return Array.from(document.querySelectorAll(arguments[0]), function (a) {
+    return [a.href, a.href.replace(/\\/+$/, "").split("-").pop()];
+});
+"""
+
+def scroll_until_settled(driver):
+    state = driver.execute_script(SCROLL_SCRIPT, LINK_SELECTOR)
+    while True:
+        try:
+            WebDriverWait(driver, download_delay, poll_frequency=0.2).until(
+                lambda d: d.execute_script(PAGE_STATE_SCRIPT, LINK_SELECTOR) != state
+            )
+        except TimeoutException:
+            log.debug("Reached end of page scrolling")
+            return
+        state = driver.execute_script(SCROLL_SCRIPT, LINK_SELECTOR)
+
+def harvest_browser_page(driver, page):
+    harvest_start = time.perf_counter()
+    with timed("page_load"):
+        driver.get(BASE_URL.format(page))
+
+    try:
+        with timed("page_load"):
+            wait_for_element(driver, By.CSS_SELECTOR, LINK_SELECTOR)
+    except TimeoutException:
+        if not driver.execute_script(LISTING_LOADED_SCRIPT):
+            # Retried by discovery_worker and left unfinished if it keeps failing
+            raise TimeoutException(f"Page {page} did not finish loading")
+        log.warning(f"No items appeared on page {page}")
+        return []
+    with timed("scroll"):
+        scroll_until_settled(driver)
+
+    links = {}
+    with timed("link_extraction"):
+        harvested = driver.execute_script(HARVEST_SCRIPT, LINK_SELECTOR)
+    for url, media_id in harvested:
+        links.setdefault(media_id, url)
+    log.info(f"Harvested {len(links)} links on page {page} in {time.perf_counter() - harvest_start:.1f}s")
+    return [(url, None) for url in links.values()]
+
+def harvest_api_page(page):
+    params = dict(SEARCH_PARAMS, per_page=api_per_page, page=page)
+    # An incremental crawl is looking for new items, so it never reads the cache
+    data = read_api_cache(params) if crawl_mode != "incremental" else None
+    if data is None:
+        log.debug(f"Requesting search API page {page}")
+        with timed("search_api"):
+            resp = http_get(API_URL, params=dict(params, key=API_KEY))
+        if resp.status_code == 400 and page > 1:
+            # The API rejects pages past the end of its result window
+            log.info(f"Search API page {page} is out of range")
+            return []
+        if resp.status_code != 200:
+            raise RuntimeError(f"Search API call failed with status {resp.status_code}")
+        data = resp.json()
+        write_api_cache(params, data)
+    else:
+        log.debug(f"Search API page {page} served from cache")
+    hits = data.get("hits", [])
+    log.info(f"Found {len(hits)} hits on search API page {page}")
+    return [(hit["pageURL"], hit) for hit in hits]
+
+# -----------------------------------------------------------------------------
+# DISCOVERY WORKERS
+# -----------------------------------------------------------------------------
+def queue_page_items(driver, page, items):
+    # Returns the number of items on the page that were not downloaded before
+    new_items = 0
+    open_page(page)
+    for url, info in items:
+        with state_lock:
+            if url in progress["processed_urls"] or known_media_id(media_id_from_url(url)):
+                continue
+            new_items += 1
+            if url in queued_urls:
+                continue
+            queued_urls.add(url)
+        if stop_event.is_set():
+            return new_items
+        if target_reached():
+            log.info("Reached target download count")
+            return new_items
+        if content_type == "music":
+            try:
+                with timed("audio_capture"):
+                    info = resolve_audio_item(driver, url)
+            except WebDriverException as e:
+                log.error(f"Could not capture the download of {url}: {str(e)}")
+                count_failure("audio_capture")
+                fail_page(page)
+                with state_lock:
+                    queued_urls.discard(url)
+                if not driver_alive(driver):
+                    # The rest of the page waits for the discovery worker's new browser
+                    release_page(page)
+                    raise
+                continue
+        elif info is None and should_visit_item_page():
+            try:
+                with timed("item_page_visit"):
+                    visit_item_page(driver, url)
+            except WebDriverException as e:
+                # The visit is optional; a dead browser is replaced on the next page
+                log.error(f"Could not open item page {url}: {str(e)}")
+        open_page(page)
+        # Blocks while the queue is full so discovery cannot run ahead
+        with timed("queue_wait"):
+            item_queue.put((url, page, info))
+    # Only a fully queued page can be finished by the workers
+    release_page(page)
+    return new_items
+
+def harvest_page(driver, page):
+    if harvest_mode == "api_search":
+        return harvest_api_page(page)
+    return harvest_browser_page(driver, page)
+
+def discovery_worker():
+    driver = None
+    try:
+        while not target_reached() and not stop_event.is_set():
+            page = claim_page()
+            if page is None:
+                return
+            log.info(f"Processing page {page}")
+            for attempt in range(browser_restarts + 1):
+                try:
+                    if driver is None and harvest_mode != "api_search":
+                        driver = launch_driver()
+                    items = harvest_page(driver, page)
+                    break
+                except WebDriverException as e:
+                    log.error(f"Browser failed on page {page}: {str(e)}")
+                    count_failure("browser_crash")
+                    if driver is not None:
+                        quit_driver(driver)
+                        driver = None
+            else:
+                # Left unfinished so the resume point stays before this page
+                log.error(f"Giving up on page {page} after {browser_restarts} browser restarts")
+                count_failure("page_abandoned")
+                continue
+            if not items:
+                log.info(f"No more items after page {page - 1}")
+                mark_last_page(page - 1)
+                continue
+            count("pages_harvested")
+            try:
+                new_items = queue_page_items(driver, page, items)
+            except WebDriverException:
+                # The page was marked failed, so it stays unfinished for the next run
+                log.error(f"Browser died while queueing page {page}, restarting it")
+                count_failure("browser_crash")
+                quit_driver(driver)
+                driver = None
+                continue
+            if not new_items and crawl_mode == "incremental":
+                note_known_page(page)
+            maybe_flush_metadata()
     except Exception as e:
         log.error(f"Fatal error during scraping: {str(e)}")
+        stop_event.set()
     finally:
-        driver.quit()
+        if driver is not None:
+            quit_driver(driver)
+
+def start_discovery():
+    threads = []
+    for i in range(browser_workers):
+        thread = threading.Thread(target=discovery_worker, name=f"discovery-{i + 1}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    log.debug(f"Started {len(threads)} discovery workers")
+    return threads
+
+# -----------------------------------------------------------------------------
+# MAIN SCRAPING LOOP
+# -----------------------------------------------------------------------------
+def main():
+    start_postprocess()
+    start_metrics()
+    if output_mode == "shards":
+        convert_to_shards()
+    workers = start_workers()
+    transfer_display = start_transfer_display()
+    heartbeat = threading.Thread(target=lease_heartbeat, name="lease-heartbeat", daemon=True)
+    heartbeat.start()
+    discovery = start_discovery()
+    try:
+        for thread in discovery:
+            # Joined with a timeout so Ctrl+C still reaches this thread
+            while thread.is_alive():
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        log.warning("Interrupted, waiting for active downloads to finish")
+        stop_event.set()
+        for thread in discovery:
+            thread.join()
+    finally:
+        stop_workers(workers)
+        stop_postprocess()
+        stop_transfer_display(transfer_display)
+        lease_heartbeat_stop.set()
+        heartbeat.join()
+        with state_lock:
+            update_progress(progress)
+            release_leases()
+        report_item_latency()
+        stop_metrics()
+        if metadata_export:
+            export_metadata(metadata_export)
+        if output_mode == "shards":
+            close_shard()
+            export_shard_index()
         log.info("Scraping completed")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download photos, videos or music from Pixabay.")
+    parser.add_argument("content_type", choices=["photos", "videos", "music"])
+    parser.add_argument("--target", type=int, help="Number of items to download (default: target_downloads)")
+    parser.add_argument("--mode", choices=["resume", "incremental"], help="Crawl mode (default: crawl_mode)")
+    parser.add_argument("--harvest", choices=["browser", "api_search"],
+                        help="Where items are discovered (default: harvest_mode)")
+    parser.add_argument("--output", choices=["files", "shards"], help="Output layout (default: output_mode)")
+    parser.add_argument("--headed", action="store_true", help="Show the Firefox window")
+    parser.add_argument("--login", action="store_true",
+                        help="Open Firefox on the saved profile to log in to Pixabay, then exit")
+    parser.add_argument("--convert-shards", action="store_true",
+                        help="Move files already downloaded into tar shards, then exit")
+    return parser.parse_args()
+
+def setup(args):
+    # Nothing touches the disk, the network or the browser before this runs
+    global TARGET_DOWNLOADS, crawl_mode, harvest_mode, output_mode, headless
+    global progress, lease_floor, target_base, seen_ids, metadata_index
+    # Command-line values take precedence over config.json
+    if args.target is not None:
+        TARGET_DOWNLOADS = args.target
+    crawl_mode = args.mode or crawl_mode
+    harvest_mode = args.harvest or harvest_mode
+    output_mode = args.output or output_mode
+    headless = headless and not args.headed
+    select_content_type(args.content_type)
+    if content_type == "music":
+        if wire_webdriver is None:
+            log.error("Music needs selenium-wire, install it with pip install -r requirements.txt")
+            exit(1)
+        if harvest_mode != "browser":
+            log.warning("Music has no search API, harvesting listing pages in the browser")
+            harvest_mode = "browser"
+
+    for folder in [DOWNLOAD_FOLDER, API_CACHE_FOLDER]:
+        os.makedirs(folder, exist_ok=True)
+    log.debug("Required directories are created or already exist")
+    if args.login or harvest_mode == "browser" or item_resolution == "browser":
+        check_firefox()
+
+    open_state_db()
+    progress = load_progress()
+    lease_floor = progress["current_page"]
+    target_base = progress["total_downloaded"] if crawl_mode == "incremental" else 0
+    seen_ids = load_seen_ids()
+    scan_download_folder()
+    metadata_index = load_metadata_index()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    setup(args)
+    if args.login:
+        login()
+    elif args.convert_shards:
+        convert_to_shards()
+        close_shard()
+        export_shard_index()
+    else:
+        main()